@@ -0,0 +1,71 @@
+import time
+
+import internals.constants as constants
+from internals.partitions import get_redis
+from internals.sharding import NodeMembership, SERVLET_LOAD
+
+
+r = get_redis()
+membership = NodeMembership(r, None)
+
+# Location codes mapped to the last time they were migrated.
+recently_moved = {}
+
+
+def get_loads():
+    """
+    Return a dict of live nodes to lists of (cpu, location) tuples for the
+    servlets running on them.
+    """
+    loads = dict((node, []) for node in membership.live_nodes())
+    for location, value in r.hgetall(SERVLET_LOAD).items():
+        node, cpu = value.rsplit(":", 1)
+        if node not in loads:
+            continue
+        loads[node].append((float(cpu), location))
+    return loads
+
+
+def rebalance():
+    """
+    Move one location from the busiest node to the least busy node, if doing
+    so would narrow the gap between them.
+    """
+    loads = get_loads()
+    if len(loads) < 2:
+        return
+
+    totals = dict((node, sum(cpu for cpu, loc in servlets)) for
+                  node, servlets in loads.items())
+    busiest = max(totals, key=totals.get)
+    idlest = min(totals, key=totals.get)
+    if totals[busiest] < constants.node_cpu_ceiling:
+        return
+
+    gap = totals[busiest] - totals[idlest]
+    now = time.time()
+    candidates = [(cpu, loc) for cpu, loc in loads[busiest] if
+                  cpu < gap and
+                  now - recently_moved.get(loc, 0) > constants.migration_cooldown]
+    if not candidates:
+        return
+
+    cpu, location = max(candidates)
+    print "Moving %s (%.2f cores) from %s to %s" % (location, cpu, busiest,
+                                                    idlest)
+    recently_moved[location] = now
+    get_redis(location).publish("location::c::%s" % location,
+                                "%s>mig%s" % (location, idlest))
+
+
+def start():
+    try:
+        while True:
+            rebalance()
+            time.sleep(constants.servlet_metrics_period)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    start()
@@ -1,39 +1,136 @@
 import os
 import signal
-
-import redis
+import socket
+import sys
+import threading
 
 import internals.constants as constants
+import internals.entities
 from internals.entity_servlet import EntityServlet
+import internals.levelbuilder.buildings
+import internals.levelbuilder.dungeons
+import internals.levelbuilder.towns
 from internals.locations import Location
+from internals.partitions import get_redis
+import internals.regionstore as regionstore
+from internals.registry import LocationRegistry
+from internals.sharding import NODE_CHANNEL, NodeMembership
 
 
-redis_host, port = constants.redis.split(":")
-r = redis.Redis(host=redis_host, port=int(port))
+r = get_redis()
 pubsub = r.pubsub()
 
 locations = {}
+idle_servlets = []
+membership = None
+registry = None
+# Players that entered a location while it was being migrated to this node.
+pending_enters = {}
+
+
+def warm():
+    """
+    Prepare this process to act as the template for every servlet that it
+    forks. The entity classes and the building, interior, and landscape
+    feature tiles are loaded at import time. What's left on a servlet's way
+    from an assignment to its first spawn is getting the location's terrain,
+    which comes from the pregenerated stores when they have it. They're
+    opened here, so that servlets forked after this share the mappings and
+    the sublocation index instead of each reading them.
+    """
+    regionstore.open_stores()
+
+
+def fill_pool():
+    """Fork idle servlets until the pool is full."""
+    while len(idle_servlets) < constants.servlet_pool_size:
+        servlet = EntityServlet(node_id=membership.node_id)
+        servlet.start()
+        idle_servlets.append(servlet)
+
+
+def get_servlet(location, message_data, snapshot=None, pending=()):
+    """
+    Assign a location to a servlet, taking an idle one from the pool if one is
+    available.
+    """
+    while idle_servlets:
+        servlet = idle_servlets.pop(0)
+        if not servlet.is_alive():
+            continue
+        servlet.assign(location, message_data, snapshot, pending)
+        return servlet
+
+    servlet = EntityServlet(location, message_data, snapshot, pending,
+                            node_id=membership.node_id)
+    servlet.start()
+    return servlet
+
+
+def is_running(location):
+    """Return whether this node has a live servlet for `location`."""
+    if location not in locations:
+        return False
+    # is_alive() also reaps servlets that have exited.
+    if not locations[location].is_alive():
+        # Explicitly tell the GC that we're done with that location handler.
+        del locations[location]
+        return False
+    return True
+
+
+def heartbeat():
+    """
+    Periodically tell the other nodes that this node is still alive, and
+    renew the registrations of the locations that it's running.
+    """
+    membership.heartbeat()
+    registry.refresh([location for location, servlet in locations.items() if
+                      servlet.is_alive()])
+
+    # Let go of players held for migrations that were given up on. This is
+    # done by the listening thread, which owns pending_enters.
+    for location in pending_enters.keys():
+        if not registry.is_migrating(location):
+            r.publish(NODE_CHANNEL % membership.node_id, "%s>rpl" % location)
 
-MESSAGES_TO_IGNORE = ("spa", "epu", )
-MESSAGES_TO_INSPECT = ("del", "cha", )
+    t = threading.Timer(constants.node_heartbeat, heartbeat)
+    t.daemon = True
+    t.start()
 
 
 def run():
     """Start the entity server."""
 
-    master_events = {"global::enter": _on_enter}
-    for event_type in master_events:
-        pubsub.subscribe(event_type)
+    warm()
+    fill_pool()
+
+    membership.join()
+    heartbeat()
+
+    node_events = {"ent": _on_enter,
+                   "dro": _on_drop,
+                   "ado": _on_adopt,
+                   "pwm": _on_prewarm,
+                   "rpl": _on_replay}
+    pubsub.subscribe(NODE_CHANNEL % membership.node_id)
 
     for event in pubsub.listen():
-        if (event["type"] != "message" or
-            event["channel"] not in master_events):
+        if event["type"] != "message":
             continue
 
         message = event["data"]
         location, message_data = message.split(">", 1)
+        message_type, message_data = message_data[:3], message_data[3:]
 
-        master_events[event["channel"]](location, message_data)
+        if message_type in node_events:
+            node_events[message_type](location, message_data)
+
+
+def forward(location, data):
+    """Pass a message along to the servlet running `location`."""
+    get_redis(location).publish("location::c::%s" % location,
+                                "%s>%s" % (location, data))
 
 
 def _on_enter(location, message_data):
@@ -42,25 +139,81 @@ def _on_enter(location, message_data):
     handler object. If so, fork the process and do the deed.
     """
 
-    # TODO: Put sharding code here.
+    if is_running(location):
+        forward(location, "ent%s" % message_data)
+        return
+
+    # If the location is on its way here from another node, hold on to the
+    # player until it arrives.
+    if registry.is_migrating(location):
+        pending_enters.setdefault(location, []).append(message_data)
+        return
+
+    # The migration never finished, so the players that were held enter like
+    # this one does.
+    held = pending_enters.pop(location, None)
+    if held:
+        for held_data in held + [message_data]:
+            _on_enter(location, held_data)
+        return
+
+    # Make sure that nobody else has started running the location since the
+    # message was sent.
+    owner = registry.claim(location, membership.node_id)
+    if owner != membership.node_id:
+        r.publish(NODE_CHANNEL % owner,
+                  "%s>ent%s" % (location, message_data))
+        return
+
+    locations[location] = get_servlet(location, message_data)
+    fill_pool()
+
+
+def _on_prewarm(location, message_data):
+    """
+    Start a servlet for a location that a player is about to enter, unless
+    the location is already running somewhere.
+    """
+    if is_running(location) or registry.is_migrating(location):
+        return
+    if registry.claim(location, membership.node_id) != membership.node_id:
+        return
+
+    locations[location] = get_servlet(location, None)
+    fill_pool()
+
+
+def _on_replay(location, message_data):
+    """
+    Let in the players that were held for a location whose migration
+    marker has expired.
+    """
+    if registry.is_migrating(location):
+        return
+    for held_data in pending_enters.pop(location, ()):
+        _on_enter(location, held_data)
+
+
+def _on_drop(location, message_data):
+    """Hand an item that a player dropped to the location's servlet."""
+    if is_running(location):
+        forward(location, "dro%s" % message_data)
+
 
-    if location in locations:
-        # See whether the process has despawned.
-        try:
-            os.getsid(locations[location].pid)
-        except OSError:
-            # Explicitly tell the GC that we're done with that location
-            # handler.
-            del locations[location]
-        else:
-            return
+def _on_adopt(location, snapshot):
+    """Take over a running location from another node."""
+    print "Adopting %s" % location
+    locations[location] = get_servlet(location, None, snapshot,
+                                      pending_enters.pop(location, ()))
+    fill_pool()
 
-    loc = EntityServlet(location, message_data)
-    loc.start()
-    locations[location] = loc
 
+def start(node_id=None):
+    global membership, registry
+    membership = NodeMembership(r, node_id or socket.gethostname())
+    registry = LocationRegistry(r, membership)
+    print "Starting entity node %s" % membership.node_id
 
-def start():
     try:
         run()
     except KeyboardInterrupt, SystemExit:
@@ -69,7 +222,12 @@ def start():
                 os.kill(locations[location].pid, signal.CTRL_C_EVENT)
             except:
                 pass
+        for servlet in idle_servlets:
+            servlet.terminate()
+        membership.leave()
 
 
 if __name__ == "__main__":
-    start()
+    # Several entity nodes can be run on one machine by giving each of them a
+    # name: `python entity_server.py node-a`
+    start(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -4,7 +4,9 @@ import brukva
 
 import internals.comm as comm
 from internals.constants import (CHAT_DISTANCE, HURT_DISTANCE,
-                                 MESSAGES_WITH_GUIDS, tilesize)
+                                 MESSAGES_WITH_GUIDS, interest_radius,
+                                 tilesize)
+from internals.interest import RELAY_MARK, split_header
 
 
 def distance(pos1, pos2):
@@ -21,14 +23,50 @@ def setup_brukva(client):
             return None
         return message[3:].split(":", 1)[0]
 
-    def on_notify_location(location, message):
+    def relay(location, message, cell=None):
         """
-        Handle an inbound message for a location that we're subscribed to.
+        Pass a message that nothing on the web node acts on to every client in
+        the location that's interested in it.
+        """
+        clients = comm.locations.get(location)
+        if not clients:
+            return
+        message_type = message[:3]
+        if message_type == "epu" and cell is not None:
+            comm.last_known[location].record(message, cell)
+        elif message_type == "die":
+            comm.last_known[location].forget(message[3:])
+
+        if cell is None:
+            for client in clients:
+                client.write_message(message)
+            return
+
+        # This is InterestArea.can_see(), unrolled for speed.
+        left, right = cell[0] - interest_radius, cell[0] + interest_radius
+        top, bottom = cell[1] - interest_radius, cell[1] + interest_radius
+        for client in clients:
+            seen_from = client.interest.cell
+            if (seen_from is None or
+                (left <= seen_from[0] <= right and
+                 top <= seen_from[1] <= bottom)):
+                client.write_message(message)
+
+    def on_notify_location(location, message, cell=None):
+        """
+        Handle an inbound message for a location that we're subscribed to. If
+        the message is tagged with a cell, it's only sent to clients that are
+        interested in that cell.
         """
         guid = get_guid(message)
 
         if location in comm.locations:
             message_type = message[:3]
+            if message_type == "loc" and cell is not None:
+                comm.last_known[location].record(message, cell)
+            elif message_type == "del":
+                comm.last_known[location].forget(guid)
+
             if message_type == "giv":
                 message_data = message.split(":")[1]
             elif message_type == "cha":
@@ -51,22 +89,9 @@ def setup_brukva(client):
                         continue
                 if guid and client.id == guid:
                     continue
-                client.write_message(message)
-
-    def on_enter(message):
-        """
-        Hande an inbound message for a player that's joining a new location.
-        """
-        location, client_data = message.split(">", 1)
-        guid, foo = client_data.split(":", 1)
-        if location in comm.locations:
-            for client in comm.locations[location]:
-                if client.id == guid:
+                if not client.interest.can_see(cell):
                     continue
-                client.write_message("add%s" % client_data)
-
-    # Define the different kinds of messages that we can receive.
-    channels = {"global::enter": on_enter}
+                client.write_message(message)
 
     def on_message(message):
         """Route an inbound message to the proper function."""
@@ -80,11 +105,15 @@ def setup_brukva(client):
         if message.kind != "message":
             return
 
-        if message.channel in channels:
-            channels[message.channel](message.body)
-        else:
-            location, message = message.body.split(">", 1)
-            on_notify_location(location, message)
+        header, message = message.body.split(">", 1)
+        if header[0] == RELAY_MARK:
+            location, cell = split_header(header[1:])
+            relay(location, message, cell)
+            return
+        location, cell = split_header(header)
+        on_notify_location(location, message, cell)
 
-    client.subscribe("global::enter")
+    # Messages addressed to every web node. This also keeps the connection in
+    # subscribed mode before any players have joined a location.
+    client.subscribe("global::web")
     client.listen(on_message)
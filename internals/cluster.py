@@ -0,0 +1,172 @@
+import hmac
+import json
+import time
+import uuid
+
+import redis
+
+import internals.constants as constants
+from internals.partitions import get_redis
+from internals.sharding import HashRing, NodeMembership
+
+
+WORKER_SET = "web:workers"
+WORKER_HEARTBEAT = "web:worker:%s"
+# A hash of web workers to the number of players that they're hosting in a
+# location. This lives on the location's Redis instance.
+LOCATION_WORKERS = "l:w:%s"
+# The state of a player who is reconnecting to another web worker.
+HANDOFF = "l:h:%s"
+# A sorted set of the players being handed off, by when they're given up on.
+HANDOFF_DEADLINES = "web:handoffs"
+
+global_redis = get_redis()
+
+# This gets set by join() to the membership of this worker. Workers are
+# identified by the address that players reconnect to them at.
+membership = None
+
+
+def join(address):
+    global membership
+    membership = NodeMembership(global_redis, address, node_set=WORKER_SET,
+                                node_heartbeat=WORKER_HEARTBEAT)
+    membership.join()
+
+
+def heartbeat():
+    if membership:
+        membership.heartbeat()
+
+
+def leave():
+    if membership:
+        membership.leave()
+
+
+def player_joined(location):
+    if membership:
+        get_redis(location).hincrby(LOCATION_WORKERS % location,
+                                    membership.node_id, 1)
+
+
+def player_left(location):
+    if not membership:
+        return
+    outbound_redis = get_redis(location)
+    key = LOCATION_WORKERS % location
+    if outbound_redis.hincrby(key, membership.node_id, -1) <= 0:
+        outbound_redis.hdel(key, membership.node_id)
+
+
+def rank_workers(counts, worker):
+    """
+    Given a dict of workers to the number of players they host in a location,
+    return the workers that host more of them than `worker` does, busiest
+    first.
+    """
+    local = int(counts.get(worker, 0))
+    better = [(int(count), other) for other, count in counts.items() if
+              other != worker and int(count) > local]
+    better.sort(key=lambda (count, other): (-count, other))
+    return [other for count, other in better]
+
+
+def preferred_worker(location):
+    """
+    Return the worker that a player entering `location` should be moved to,
+    or None if they're best off where they are.
+    """
+    if not membership:
+        return None
+
+    counts = get_redis(location).hgetall(LOCATION_WORKERS % location)
+    for worker in rank_workers(counts, membership.node_id):
+        # Counts left behind by workers that have gone away are skipped.
+        if global_redis.exists(WORKER_HEARTBEAT % worker):
+            return worker
+    return None
+
+
+def handoff_target(location, fallback):
+    """
+    Return the worker that a player in `location` should be moved to when
+    this worker is drained. Players in the same location are sent to the same
+    worker. If there are no other workers, `fallback` is returned.
+    """
+    worker = preferred_worker(location)
+    if worker:
+        return worker
+
+    others = [worker for worker in membership.live_nodes() if
+              worker != membership.node_id]
+    if not others:
+        return fallback
+    return HashRing(others).get_node(str(location))
+
+
+def save_handoff(player_id, state):
+    """
+    Store a player's state for the worker that they're being sent to. Returns
+    the one-time token that the player has to present to resume it.
+    """
+    token = uuid.uuid4().hex
+    key = HANDOFF % player_id
+    pipe = global_redis.pipeline()
+    pipe.set(key, json.dumps(dict(state, token=token)))
+    # The state outlives the deadline so that expired_handoffs() can find it.
+    pipe.expire(key, constants.handoff_timeout * 2)
+    pipe.zadd(HANDOFF_DEADLINES,
+              {player_id: time.time() + constants.handoff_timeout})
+    pipe.execute()
+    return token
+
+
+def load_handoff(player_id, token):
+    """
+    Return (and forget) a player's handed off state, if there is any and it
+    was saved with `token`. Player IDs are seen by everyone in a location, so
+    the ID alone isn't enough to take over a session.
+    """
+    key = HANDOFF % player_id
+    with global_redis.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            state = pipe.get(key)
+            if state is None:
+                return None
+            state = json.loads(state)
+            if not hmac.compare_digest(state.pop("token").encode("utf-8"),
+                                       token.encode("utf-8")):
+                return None
+
+            # Only the first resume with the token gets the state.
+            pipe.multi()
+            pipe.delete(key)
+            pipe.zrem(HANDOFF_DEADLINES, player_id)
+            if not pipe.execute()[0]:
+                return None
+        except redis.WatchError:
+            return None
+    return state
+
+
+def expired_handoffs():
+    """
+    Return (and forget) the IDs and states of players who were handed off
+    but didn't resume in time. Each one is only returned to one worker.
+    """
+    expired = []
+    for player_id in global_redis.zrangebyscore(HANDOFF_DEADLINES, "-inf",
+                                                time.time()):
+        key = HANDOFF % player_id
+        pipe = global_redis.pipeline()
+        pipe.zrem(HANDOFF_DEADLINES, player_id)
+        pipe.get(key)
+        pipe.delete(key)
+        removed, state, deleted = pipe.execute()
+        if removed and state is not None:
+            state = json.loads(state)
+            del state["token"]
+            expired.append((player_id, state))
+    return expired
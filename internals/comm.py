@@ -1,34 +1,140 @@
-import json
 import logging
 import math
 import random
 import re
 import time
 
-import redis
 import tornado.websocket
 
+import internals.cluster as cluster
 import internals.constants as constants
+import internals.generation as generation
+import internals.instances as instances
+import internals.levelcache as levelcache
+import internals.metrics as metrics
+import internals.prefetch as prefetch
 from internals.harmable import Harmable
+from internals.interest import InterestArea, LastKnown, get_cell, tag
 from internals.inventory import InventoryManager
 from internals.locations import Location
+from internals.outbound import FRAME_SEPARATOR, OutboundQueue, pack_frame
+from internals.partitions import get_endpoint, get_redis
+from internals.positions import PositionStore
+from internals.registry import LocationRegistry
 from internals.scheduler import Scheduler
+from internals.sharding import NodeMembership
 
 
 REQUIRE_GUID = ("pos", "dir", "ups", "cha", )
 REQUIRE_SCENE = ("dir", "ups", "cha", )
 
-redis_host, redis_port = constants.redis.split(":")
-outbound_redis = redis.Redis(host=redis_host, port=int(redis_port))
+global_redis = get_redis()
+registry = LocationRegistry(global_redis, NodeMembership(global_redis, None))
 
-# This should get set by web_server.py
+# This should get set by web_server.py to a dict of Redis endpoints to brukva
+# clients.
 brukva = None
 connections = []
 locations = {}
+# The locations in `locations` mapped to the LastKnown updates from them.
+last_known = {}
+# Player positions waiting to be written to Redis. web_server.py flushes this
+# every constants.position_flush_interval seconds.
+positions = PositionStore()
+# Connections with movement input waiting for the next tick.
+pending_input = set()
+# Connections with messages queued behind a backed up socket, or waiting to
+# be packed into the next frame.
+backlogged = set()
+
+
+def process_input():
+    """Handle the latest movement input from each connection."""
+    clients = list(pending_input)
+    pending_input.clear()
+    for client in clients:
+        data, client.pending_position = client.pending_position, None
+        if data is not None:
+            metrics.incr("input.processed")
+            client._on_position_update(data)
+
+
+def flush_outbound():
+    """
+    Write queued messages to the clients whose sockets have caught up. This
+    also sends the frames of clients that pack their messages together.
+    """
+    depths = [len(client.outbound) for client in backlogged]
+    metrics.set_gauge("outbound.backlogged", len(depths))
+    metrics.set_gauge("outbound.queued", sum(depths))
+    metrics.set_gauge("outbound.max_depth", max(depths) if depths else 0)
+
+    for client in list(backlogged):
+        if not client.socket_busy():
+            client.flush_outbound()
+
+
+def merge_instances():
+    """
+    Move the players in sparsely populated instances on this worker into
+    lower instances with room for them.
+    """
+    for loc_str, clients in locations.items():
+        location = clients[0].location
+        destination = instances.merge_target(location)
+        if not destination:
+            continue
+        print "Merging %s into %s" % (loc_str, destination)
+        for client in list(clients):
+            client.merge_instance(destination)
+
+
+def notify_location(location, data, for_entities=False, position=None):
+    """
+    Broadcast a blob of data to all of the other listeners in a particular
+    location.
+
+    If for_entities is True, the message will not be broadcast to other
+    players and will only be received by the appropriate entity server.
+    Messages that entities don't act on are never sent to the entity server.
+
+    If position is set, clients that are far away from it will not receive
+    the message.
+    """
+    message = "%s>%s" % (tag(location, position, data[:3]), data)
+    pipe = get_redis(location).pipeline(transaction=False)
+    if not for_entities:
+        pipe.publish("location::r::%s" % location, message)
+    if data[:3] in constants.ENTITY_MESSAGES:
+        pipe.publish("location::i::%s" % location, message)
+    pipe.execute()
+
+
+def announce_departure(location, player_id):
+    """
+    Remove a player's presence from a location and tell everyone in it that
+    they've left.
+    """
+    outbound_redis = get_redis(location)
+    outbound_redis.srem("l:c:%s" % location, player_id)
+    outbound_redis.delete("l:p:%s" % player_id)
+    notify_location(location, "del%s" % player_id)
+
+
+def expire_handoffs():
+    """
+    Treat players who were handed off to another worker but never reconnected
+    as having left. Drained players are still present in their locations
+    until this happens.
+    """
+    for player_id, state in cluster.expired_handoffs():
+        if "position" in state:
+            announce_departure(state["location"], player_id)
 
 
 def strip_tags(data):
     data = re.compile(r'<[^<]*?>').sub('', data)
+    data = data.replace(FRAME_SEPARATOR, "")
     return data.replace("<", "&lt;").replace(">", "&gt;")
 
 class CommHandler(Harmable, InventoryManager,
@@ -40,6 +146,17 @@ class CommHandler(Harmable, InventoryManager,
         # Define variables to store state information.
         self.id = None
         self.location = None
+        # The location that's being generated for the player to enter, and
+        # where in it they're entering.
+        self.loading = None
+        self.loading_position = None
+        # The latest level change that the player asked for while a level
+        # was loading, as a method and its arguments.
+        self.next_load = None
+        # The levels that the player could move into from where they are, and
+        # the content codes of the ones that have been prefetched.
+        self.prefetch_targets = []
+        self.prefetched = set()
 
         self.position = 0, 0
         self.parent_positions = []
@@ -49,25 +166,71 @@ class CommHandler(Harmable, InventoryManager,
 
         self.chat_name = ""
         self.last_update = 0
+        # The last published position, velocity and time.
+        self.reckoning = None
+
+        # The latest movement input, which is handled on the next tick.
+        self.pending_position = None
+        self.input_window = 0
+        self.input_count = 0
+
+        self.interest = InterestArea()
+        self.outbound = OutboundQueue()
+        # Whether messages are held until the next tick and sent together in
+        # one frame.
+        self.multi_frames = False
 
         self.scheduler = Scheduler(constants.tilesize / constants.speed / 1000,
                                    self._on_schedule_event)
 
     def open(self):
         super(CommHandler, self).open()
+        self.multi_frames = self.get_argument("frames", "0") == "1"
         self.write_message("elo")
         connections.append(self)
 
     def on_close(self):
         CommHandler.del_client(self)
         connections.remove(self)
+        pending_input.discard(self)
+        backlogged.discard(self)
         self.location = None
+        self.loading = None
+        self.next_load = None
+        self._settle_prefetches(None)
+
+    def write_message(self, message):
+        """
+        Send a message to the client. If the socket is backed up, the message
+        is queued until it isn't. Clients that use multi-message frames have
+        every message queued until the next tick.
+        """
+        self.outbound.push(message)
+        if self.multi_frames or self.socket_busy():
+            backlogged.add(self)
+        else:
+            self.flush_outbound()
+
+    def socket_busy(self):
+        """Return whether earlier writes are still waiting on the socket."""
+        return self.stream is not None and self.stream.writing()
+
+    def flush_outbound(self):
+        backlogged.discard(self)
+        messages = self.outbound.pop_all()
+        metrics.incr("outbound.sent", len(messages))
+        if self.multi_frames and len(messages) > 1:
+            messages = [pack_frame(messages)]
+        for message in messages:
+            metrics.incr("outbound.frames")
+            super(CommHandler, self).write_message(message)
 
     def on_message(self, message):
         callbacks = {"reg": self._register,
+                     "res": self._resume,
                      "lev": self._level_slide,
                      "cha": self._on_chat,
-                     "loc": self._on_position_update,
+                     "loc": self._queue_position_update,
                      "use": self.use_item,
                      "dro": self.drop_item,
                      "cyc": self.cycle_items}
@@ -92,6 +255,26 @@ class CommHandler(Harmable, InventoryManager,
         else:
             self.write_message("errUnknown Command")
 
+    def _queue_position_update(self, data):
+        """
+        Hold on to movement input until the next tick. Only the latest input
+        is kept, so a client can't make the server do more work by sending
+        more packets. Input beyond constants.max_input_rate packets a second
+        is always counted as merged, but it still replaces the held input so
+        that the client's newest state isn't lost.
+        """
+        metrics.incr("input.received")
+        now = time.time()
+        if now - self.input_window >= 1:
+            self.input_window = now
+            self.input_count = 0
+        self.input_count += 1
+        if (self.input_count > constants.max_input_rate or
+            self.pending_position is not None):
+            metrics.incr("input.merged")
+        self.pending_position = data
+        pending_input.add(self)
+
     def _on_position_update(self, data):
         x, y, x_dir, y_dir = 0, 0, 0, 0
         try:
@@ -120,8 +303,7 @@ class CommHandler(Harmable, InventoryManager,
         # hitmapping isn't blocked on Redis.
         self.scheduler.event_happened()
 
-        outbound_redis.set("l:p:%s" % self.id,
-                           "%s:%d:%d" % (self.id, x, y))
+        positions.update(self.location, self.id, x, y)
 
         now = time.time() * 1000
         if now - self.last_update < 5:
@@ -176,6 +358,78 @@ class CommHandler(Harmable, InventoryManager,
         # location from the database.
         return self._level_slide("%d:%d:%d:%d" % (0, 0, -1, -1))
 
+    def _resume(self, data):
+        """Pick up a player that another web worker has redirected here."""
+        if ":" not in data:
+            self.write_message("errNo session to resume")
+            return
+        player_id, token = data.strip().rsplit(":", 1)
+        state = cluster.load_handoff(player_id, token)
+        if state is None:
+            self.write_message("errNo session to resume")
+            return
+
+        self.id = player_id
+        self.chat_name = state["chat_name"]
+        self.health = state["health"]
+        self.inventory = dict((int(slot), item) for slot, item in
+                              state["inventory"].items())
+        self.parent_positions = map(tuple, state["parent_positions"])
+        self.update_inventory()
+        self.update_health()
+
+        if "avx" in state:
+            self._load_level(state["location"], state["avx"], state["avy"],
+                             redirect=False)
+            return
+
+        # The player was drained from another worker. The client still has
+        # the level and everyone in the location still knows about the
+        # player, so just pick up where the other worker left off.
+        self.location = Location(state["location"])
+        self.position = tuple(state["position"])
+        self.direction = tuple(state["direction"])
+        self.interest.reset(self.position)
+        CommHandler.add_client(self.location, self, announce=False)
+        positions.update(self.location, self.id, *self.position)
+        # Portals and slides need the terrain, so have it generated now.
+        generation.load(self.location, lambda loaded: None)
+
+    def redirect(self, worker, avx=None, avy=None):
+        """
+        Save the player's state and send them to another web worker.
+
+        If `avx` and `avy` are set, the other worker loads the level that the
+        player was about to enter at that position. Otherwise, the player
+        stays where they are without the level being reloaded or anyone being
+        told that they left.
+        """
+        state = {"location": str(self.location),
+                 "health": self.health,
+                 "inventory": self.inventory,
+                 "chat_name": self.chat_name,
+                 "parent_positions": self.parent_positions}
+        if avx is None:
+            state["position"] = self.position
+            state["direction"] = self.direction
+            CommHandler.del_client(self, announce=False)
+        else:
+            state["avx"], state["avy"] = avx, avy
+        token = cluster.save_handoff(self.id, state)
+
+        # The player isn't in the location on this worker any more, so
+        # there's nothing to clean up when the connection closes.
+        self.location = None
+        self.write_message("rdr%s:%s" % (worker, token))
+        self.close()
+
+    def merge_instance(self, destination):
+        """Move the player to another instance of the level they're in."""
+        x, y = self.position
+        self.write_message("flv%s" % destination)
+        self._load_level(destination, x / constants.tilesize,
+                         y / constants.tilesize, redirect=False)
+
     def _level_slide(self, data):
         x, y, avx, avy = 0, 0, 0, 0
         try:
@@ -183,6 +437,10 @@ class CommHandler(Harmable, InventoryManager,
         except ValueError:
             self.write_message("errInvalid level id")
             return
+        if self.loading:
+            # Where the player slides to depends on the level that's loading.
+            self.next_load = self._level_slide, (data, )
+            return
 
         try:
             level_width = self.location.width()
@@ -214,8 +472,27 @@ class CommHandler(Harmable, InventoryManager,
         else:
             self._load_level(self.location.get_slide_code(x, y), avx, avy)
 
-    def _load_level(self, data, avx=None, avy=None):
-        """Send the client a level to load as the active level."""
+    def _load_level(self, data, avx=None, avy=None, redirect=True):
+        """
+        Send the client a level to load as the active level.
+
+        If `redirect` is set, the player is placed in the first instance of
+        the level with room for them, and if another web worker hosts more of
+        that instance's players than this one, the client is sent there
+        instead.
+
+        The level is generated off the IOLoop if it has to be, so the player
+        isn't in any location until it's ready. If a level is already
+        loading, the latest level asked for is loaded once it's ready.
+        """
+        # Movement input held from the level that's being left doesn't apply
+        # to the next one.
+        self.pending_position = None
+
+        if self.loading:
+            self.next_load = self._load_level, (data, avx, avy, redirect)
+            return
+
         sl = self.location
         if sl:
             CommHandler.del_client(self)
@@ -223,26 +500,60 @@ class CommHandler(Harmable, InventoryManager,
         # Create the location
         if data.startswith(":"):
             self.parent_positions.append(self.position)
-            self.location = Location(str(sl) + data)
+            location = Location(str(sl) + data)
         elif data == "..":
-            sublocs = map(sl._reconstitute_sublocation,
-                          sl.sublocations[:-1])
-            sublocs = ":%s" % ":".join(sublocs) if sublocs else ""
-
-            loc = "%s:%s%s" % (sl.world, "%d:%d" % sl.coords, sublocs)
-            self.location = Location(loc)
+            location = Location(sl.get_parent_code())
             self.position = self.parent_positions.pop()
             avx, avy = map(lambda x: x / constants.tilesize, self.position)
             avy += 1.3  # So we don't land back on the portal
         else:
-            self.location = Location(data)
+            location = Location(data)
+            if redirect and not location.instance:
+                location = Location(instances.choose_instance(location))
             self.position = avx, avy
 
-        level = self.location.render(avx, avy)
-        level["health"] = self.health
-        self.write_message("lev%s" % json.dumps(level))
+        if redirect and self.id:
+            worker = cluster.preferred_worker(location)
+            if worker:
+                self.location = location
+                self.redirect(worker, avx, avy)
+                return
 
-        CommHandler.add_client(self.location, self)
+        self.location = None
+        self.loading = location
+        self.loading_position = avx, avy
+
+        def on_load(loaded):
+            # The player may have disconnected while the level was generated.
+            if self.loading is not location:
+                return
+            self.loading = None
+            if not loaded:
+                self.write_message("errCould not load the level")
+                self._load_next()
+                return
+
+            self.location = location
+            self._settle_prefetches(location)
+            # The client fetches the level's content from /level/ (or its own
+            # cache), so only the parts that are particular to the player are
+            # sent here.
+            self.interest.reset((avx * constants.tilesize,
+                                 avy * constants.tilesize))
+            self.write_message(levelcache.level_message(
+                    location, avx, avy, self.health))
+
+            CommHandler.add_client(location, self)
+            self._load_next()
+
+        generation.load(location, on_load)
+
+    def _load_next(self):
+        """Change to the level that the player asked for during a load."""
+        if self.next_load:
+            load, args = self.next_load
+            self.next_load = None
+            load(*args)
 
     def _on_schedule_event(self, scheduled):
         """Handle scheduled events regarding position."""
@@ -263,12 +574,25 @@ class CommHandler(Harmable, InventoryManager,
             x += velocity[0] * duration * constants.speed
             y += velocity[1] * duration * constants.speed
             self.position = x, y
-
-        self._notify_location(self.location,
-                              "loc%s:%d:%d:%d:%d" %
-                                  (self.id, x, y,
-                                   self.velocity[0], self.velocity[1]),
-                              for_entities=scheduled)
+        old_cell = self.interest.cell
+        if self.interest.update((x, y)):
+            self._resync(old_cell)
+
+        # Everyone else extrapolates from the last published position, so
+        # scheduled updates are only needed if that's gone wrong, or if the
+        # player has moved into view of clients that haven't heard from them.
+        now = time.time()
+        if (not scheduled or self._drifted(x, y, now) or
+            get_cell((x, y)) != get_cell(self.reckoning[:2])):
+            self.reckoning = x, y, self.velocity, now
+            self._notify_location(self.location,
+                                  "loc%s:%d:%d:%d:%d:%d" %
+                                      (self.id, x, y,
+                                       self.velocity[0], self.velocity[1],
+                                       now * 1000),
+                                  for_entities=scheduled, position=(x, y))
+        else:
+            metrics.incr("movement.suppressed")
 
         portals = self.location.generate()[2]
         x_t, y_t = x / constants.tilesize, y / constants.tilesize
@@ -295,8 +619,74 @@ class CommHandler(Harmable, InventoryManager,
                                      portal["dest_coords"][1])
                     break
 
+        if any(self.velocity):
+            self._prefetch(x_t, y_t)
+
         return any(self.velocity)
 
+    def _prefetch(self, x_t, y_t):
+        """
+        Generate the levels that the player is close to moving into and start
+        their entity servlets, so that there's no wait when they get there.
+        """
+        for code in prefetch.due(self.prefetch_targets, x_t, y_t):
+            location = Location(code)
+            content_code = levelcache.content_code(location)
+            if content_code in self.prefetched:
+                continue
+            self.prefetched.add(content_code)
+            metrics.incr("prefetch.started")
+
+            generation.load(location, lambda loaded, location=location:
+                                self._on_prefetched(location, loaded))
+            self._notify_owner(code, "pwm")
+
+    def _on_prefetched(self, location, loaded):
+        if (loaded and constants.prefetch_push and self.location and
+            levelcache.content_code(location) in self.prefetched):
+            self.write_message(levelcache.prefetch_message(location))
+
+    def _settle_prefetches(self, location):
+        """
+        Count whether the level that the player moved into (if any) was
+        prefetched and how many prefetches went unused, then find the levels
+        to prefetch from the new location.
+        """
+        if location and levelcache.content_code(location) in self.prefetched:
+            metrics.incr("prefetch.hit")
+            self.prefetched.discard(levelcache.content_code(location))
+        elif location:
+            metrics.incr("prefetch.miss")
+        metrics.incr("prefetch.wasted", len(self.prefetched))
+        self.prefetched = set()
+        self.prefetch_targets = prefetch.targets(location) if location else []
+
+    def _resync(self, old_cell):
+        """
+        Send the player the latest updates from the cells that their area has
+        just moved over.
+        """
+        seen = last_known.get(str(self.location))
+        if seen is None:
+            return
+        for message in seen.newly_visible(self.interest.cell, old_cell):
+            if message[3:].split(":", 1)[0] != self.id:
+                self.write_message(message)
+
+    def _drifted(self, x, y, now):
+        """
+        Return whether the player is too far from where their last published
+        position and velocity would put them.
+        """
+        if self.reckoning is None:
+            return True
+        r_x, r_y, velocity, then = self.reckoning
+        travelled = (now - then) * 1000 * constants.speed
+        return (abs(r_x + velocity[0] * travelled - x) >
+                    constants.dead_reckoning_threshold or
+                abs(r_y + velocity[1] * travelled - y) >
+                    constants.dead_reckoning_threshold)
+
     def _attacked(self, attack_distance, attacked_by, attacked_with):
         """Handle an attack on the player."""
         if attacked_by == self.id:
@@ -348,65 +738,82 @@ class CommHandler(Harmable, InventoryManager,
         return self.inventory.values()
 
     @classmethod
-    def add_client(cls, location, client):
-        """Add a client to a level in the game."""
+    def add_client(cls, location, client, announce=True):
+        """
+        Add a client to a level in the game. If `announce` is False, the
+        client is assumed to already be known to the location (e.g., when it
+        has been handed over from another worker).
+        """
         loc_str = str(location)
         x, y = client.position
 
         if loc_str not in locations:
             locations[loc_str] = []
+            last_known[loc_str] = LastKnown()
         locations[loc_str].append(client)
+        if client.id:
+            cluster.player_joined(loc_str)
 
         # Subscribe to the location if we aren't subscribed already.
-        brukva.subscribe("location::p::%s" % loc_str)
-        brukva.subscribe("location::e::%s" % loc_str)
+        brukva[get_endpoint(loc_str)].subscribe("location::r::%s" % loc_str)
+        if not announce:
+            return
+
         # Let everyone know that we're here.
-        client._notify_global(
-                "enter",
-                "%s>%s:%d:%d" % (loc_str, client.id, x, y))
+        client._notify_owner(loc_str, "ent%s:%d:%d" % (client.id, x, y))
+        client._notify_location(loc_str, "add%s:%d:%d" % (client.id, x, y))
 
+        outbound_redis = get_redis(loc_str)
         client_set = "l:c:%s" % loc_str
-        for rclient in outbound_redis.smembers(client_set):
-            client_location = outbound_redis.get("l:p:%s" % rclient)
-            client.write_message("add%s" % client_location)
-        outbound_redis.sadd(client_set, client.id)
-        outbound_redis.set("l:p:%s" % client.id,
-                           "%s:%d:%d" % (client.id, client.position[0],
-                                         client.position[1]))
+        rclients = outbound_redis.smembers(client_set)
+        if rclients:
+            # Positions are written behind, so they may be a little stale.
+            for client_location in outbound_redis.mget(
+                    ["l:p:%s" % rclient for rclient in rclients]):
+                if client_location:
+                    client.write_message("add%s" % client_location)
+
+        position = "%s:%d:%d" % (client.id, x, y)
+        pipe = outbound_redis.pipeline(transaction=False)
+        pipe.sadd(client_set, client.id)
+        pipe.set("l:p:%s" % client.id, position)
+        pipe.execute()
+        positions.wrote(client.id, position)
 
     @classmethod
-    def del_client(cls, client):
+    def del_client(cls, client, announce=True):
+        """
+        Remove a client from its level. If `announce` is False, the client's
+        presence in the location is left alone for another worker to take
+        over.
+        """
         if not client.location or not client.id:
             return
 
-        outbound_redis.srem("l:c:%s" % str(client.location), client.id)
-        outbound_redis.delete("l:p:%s" % client.id)
-        client._notify_location(client.location, "del%s" % client.id)
-
         loc_str = str(client.location)
+        # Either the position key is deleted or the next worker takes over
+        # writing it.
+        positions.discard(client.id)
+        if announce:
+            announce_departure(loc_str, client.id)
+
         locations[loc_str].remove(client)
+        cluster.player_left(loc_str)
         if not locations[loc_str]:
             del locations[loc_str]
-            brukva.unsubscribe("location::p::%s" % loc_str)
-            brukva.unsubscribe("location::e::%s" % loc_str)
-
-    def _notify_location(self, location, data, for_entities=False):
-        """
-        Broadcast a blob of data to all of the other listeners in a particular
-        location.
+            del last_known[loc_str]
+            brukva[get_endpoint(loc_str)].unsubscribe(
+                    "location::r::%s" % loc_str)
 
-        If for_entities is True, the message will not be broadcast to other
-        players and will only be received by the appropriate entity server.
-        """
-        channel = "location::p::%s" if not for_entities else "location::pe::%s"
-        outbound_redis.publish(channel % location,
-                               "%s>%s" % (location, data))
+    def _notify_location(self, location, data, for_entities=False,
+                         position=None):
+        notify_location(location, data, for_entities, position)
 
-    def _notify_global(self, data_type, data):
+    def _notify_owner(self, location, data):
         """
-        Broadcast a message to all nodes that are listening on the various
-        global channels. This should be used sparingly, as these messages reach
-        all of the entity server and all of the web server instances.
+        Send a message to the entity node that runs a location. No other entity
+        or web server instances receive it.
         """
-        outbound_redis.publish("global::%s" % data_type, data)
+        if not registry.publish(location, data):
+            print "No entity nodes are available for %s" % location
 
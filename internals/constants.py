@@ -1,7 +1,28 @@
 memcached = "127.0.0.1:11211"
 redis = "127.0.0.1:6379"
+# Each location's channels and presence keys live on one of these Redis
+# instances. Global channels and keys (entity nodes, location owners) stay on
+# `redis`.
+redis_locations = [redis]
 
 port = 8080
+# The number of pre-forked web workers sharing `port`. Each worker also listens
+# on a port of its own (port + 1, port + 2, ...) that players are redirected
+# to.
+web_workers = 1
+# How long (in seconds) a player's state is kept while they reconnect to
+# another web worker. Players who haven't reconnected by then are treated as
+# having left.
+handoff_timeout = 30
+# Movement packets beyond this many per second from one client are counted as
+# merged into the input held for the next tick.
+max_input_rate = 60
+# How often (in seconds) web workers write changed player positions to Redis.
+position_flush_interval = 0.5
+# When a web worker is drained, it moves this many players to other workers
+# every drain_interval seconds.
+drain_batch_size = 25
+drain_interval = 1
 
 level_grad_resolution = 4
 level_width = 75
@@ -10,10 +31,100 @@ tilesize = 50
 framerate = 30  # FPS
 speed = 0.2  # Pixels per tick
 
+# Moving players' positions are only published while they're moving if
+# they've strayed this many pixels from where their last published position
+# and velocity put them. Entity servlets extrapolate the rest of the way
+# every dead_reckoning_period seconds.
+dead_reckoning_threshold = tilesize / 2
+dead_reckoning_period = tilesize / speed / 1000
+
+# Bump this whenever level generation changes. Clients cache level content by
+# version and location code.
+level_version = 1
+# The number of serialized levels each web worker keeps in memory.
+level_cache_size = 256
+# Whether cached levels also keep a gzipped copy to serve to browsers.
+level_gzip = True
+# How long (in seconds) browsers may cache level content.
+level_max_age = 60 * 60 * 24 * 365
+# The number of processes each web worker generates levels in. With none,
+# levels are generated on the IOLoop.
+generation_processes = 2
+# Where pregenerated worlds are stored, one file per world, and how far from
+# the origin (in regions) they extend. Each region's portals have to fit in
+# region_portal_size bytes to be stored.
+region_store_path = "regions"
+region_store_radius = 64
+region_portal_size = 2048
+# Levels that a player is heading for are generated, and their entity servlets
+# started, once the player is this many tiles from the edge or portal that
+# leads there.
+prefetch_distance = 4
+# Whether clients are told to fetch prefetched levels' content too.
+prefetch_push = True
+# How long (in seconds) a servlet started ahead of a player waits for someone
+# to enter before it's cleaned up.
+prewarm_timeout = 30
+# How often (in seconds) the IOLoop checks how late it is running.
+stall_check_interval = 0.1
+
 entity_despawn_time = 60 * 10
+# The number of idle entity servlets kept forked and waiting for a location.
+servlet_pool_size = 4
+
+# The number of points each entity node gets on the location hash ring.
+virtual_nodes = 64
+# How often (in seconds) entity nodes announce that they're alive, and how
+# long they're considered alive after their last announcement.
+node_heartbeat = 5
+node_timeout = 15
+
+# How often (in seconds) servlets report their CPU usage.
+servlet_metrics_period = 5
+# How long (in seconds) a node waits for a migrating location to arrive
+# before giving up on it.
+migration_timeout = 10
+# A node using more than this many CPU cores across its servlets will have
+# locations migrated away from it, provided that a node with more headroom
+# exists.
+node_cpu_ceiling = 0.8
+# The balancer won't move the same location again within this many seconds.
+migration_cooldown = 60
+
+# Once this many players are in a location, new arrivals are placed in a
+# separate instance of it with its own servlet and channels. Set it to None to
+# disable instancing.
+instance_capacity = 50
+# Instances with this many players or fewer are merged into a lower instance
+# with room for them, checked every instance_merge_interval seconds.
+instance_merge_size = 10
+instance_merge_interval = 30
 
 MESSAGES_WITH_GUIDS = ("loc", "add", "del", "cha", "giv")
+# Player messages that entity servlets act on. Only these are published to a
+# location's entity input channel (location::i::<loc>); everything that
+# clients need to render goes to location::r::<loc>.
+ENTITY_MESSAGES = ("loc", "cha", "atk", "del")
+# Messages that web nodes pass straight through to every interested client,
+# without looking at their contents.
+RELAY_MESSAGES = ("epu", "spa", "snd", "die")
 PLAYER_RANGES = 3
+# Messages to a client that has fallen behind are queued, up to this many.
+# Queued updates to the same entity's position or properties are merged, and
+# once the queue is full, the oldest message that isn't reliable is dropped.
+outbound_queue_size = 256
+COLLAPSIBLE_MESSAGES = ("loc", "epu")
+RELIABLE_MESSAGES = ("lev", "inv", "hea", "giv", "dth", "flv", "rdr", "add",
+                     "del", "spa", "die")
+
+# Locations are divided into square cells of this many tiles. Messages about
+# something at a position are tagged with its cell, and clients only receive
+# tagged messages from cells within interest_radius cells of their own.
+interest_cell_size = 10
+interest_radius = 2
+# How far (in tiles) a player must move past the edge of their cell before
+# their area of interest follows them.
+interest_hysteresis = 2
 
 # The distance that a player can hear chat messages from.
 CHAT_DISTANCE = 8
@@ -1,16 +1,14 @@
-from random import randint
-
 from npc import NPC
 
 
 class Child(NPC):
 
-    def __init__(self, *args):
-        super(Child, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(Child, self).__init__(*args, **kwargs)
         self.messages = ["Na na na na na!", "Hahaha!",
                          "Bet I can run faster than you!"]
         # Choose a random child graphic for the child.
-        self.image = "child%d" % randint(1, 2)
+        self.image = "child%d" % self.rng.randint(1, 2)
 
         self.speed = 1
 
@@ -7,6 +7,7 @@ from math import sqrt
 
 import internals.constants as constants
 from internals.hitmapping import get_hitmap
+from internals.interest import get_cell
 from internals.scheduler import Scheduler
 
 
@@ -18,10 +19,14 @@ SQRT1_2 = sqrt(float(1) / 2)
 class Entity(object):
     """An entity is any non-player, non-terrain element of the game."""
 
-    def __init__(self, location, x=None, y=None, id=None):
+    def __init__(self, location, x=None, y=None, id=None, rng=None):
         super(Entity, self).__init__()
 
         self.dead = False
+        # The random numbers that choices about how the entity looks are made
+        # with. Entities placed with a location's own Random look the same
+        # every time the location starts.
+        self.rng = rng or random
 
         self.id = id if id else "%s%s" % (self.get_prefix(),
                                           uuid.uuid4().hex[:8])
@@ -29,6 +34,8 @@ class Entity(object):
         self.position = x, y
         self.location = location
         self.offset = 0, 0
+        # The cell of the position that was last broadcast.
+        self.broadcast_cell = None
 
         self.remembered_positions = {}
         self.remembered_distances = {}
@@ -64,6 +71,34 @@ class Entity(object):
         """Set the entity's position at X,Y coordinates."""
         self.position = x, y
 
+    def get_state(self):
+        """
+        Return a JSON-serializable dict describing the entity, used to move
+        the entity to another process. Classes that keep additional state
+        should extend the dict with super().
+        """
+        return {"type": self.__class__.__name__,
+                "id": self.id,
+                "position": self.position,
+                "remembered_positions": self.remembered_positions,
+                "remembered_distances": self.remembered_distances}
+
+    def set_state(self, state):
+        """Restore the state returned by get_state()."""
+        self.id = state["id"]
+        self.position = tuple(state["position"])
+        self.remembered_positions = dict(
+                (guid, tuple(position)) for guid, position in
+                state["remembered_positions"].items())
+        self.remembered_distances = state["remembered_distances"]
+
+    @classmethod
+    def restore(cls, location, state):
+        """Create an entity in `location` from the output of get_state()."""
+        entity = cls(location)
+        entity.set_state(state)
+        return entity
+
     def can_place_at(self, x, y, grid, hitmap):
         """
         Return a boolean value representing whether the entity can be placed at
@@ -86,7 +121,7 @@ class Entity(object):
         """
         type, message = message[:3], message[3:]
         if type == "loc":
-            guid, x, y, xvel, yvel = message.split(":")
+            guid, x, y, xvel, yvel, timestamp = message.split(":")
             self._player_movement(guid, x, y)
         elif type == "cha":
             guid, chat_data = message.split(":", 1)
@@ -163,7 +198,8 @@ class Entity(object):
         """Instruct clients to play sound `sound`."""
         self.location.notify_location(
                 "snd",
-                "%s:%d:%d" % (sound, self.position[0], self.position[1]))
+                "%s:%d:%d" % (sound, self.position[0], self.position[1]),
+                position=self.position)
 
     def _get_properties(self):
         return {"x": self.position[0] / constants.tilesize,
@@ -201,8 +237,14 @@ class Entity(object):
 
         builder = lambda x: "%s=%s" % (x, json.dumps(get_prop(x)))
         command = "\n".join(map(builder, args))
+        if "x" in args or "y" in args:
+            # The time of the position, in ms, so that clients can account for
+            # how long it took to reach them.
+            command += "\nt=%d" % (time.time() * 1000)
 
-        self.location.notify_location("epu", "%s:%s" % (self.id, command))
+        self.location.notify_location("epu", "%s:%s" % (self.id, command),
+                                      position=self.position)
+        self.broadcast_cell = get_cell(self.position)
 
         # Notify all of the entities of where we're at.
         for entity in self.location.entities:
@@ -260,11 +302,44 @@ class Animat(Entity):
                timer[1].cancel()
                self.timers.remove(timer)
 
+    def get_state(self):
+        state = super(Animat, self).get_state()
+        state["layer"] = self.layer
+        state["image"] = self.image
+        state["view"] = self.view
+        state["speed"] = self.speed
+        state["velocity"] = self.velocity
+
+        # Timers are kept by the name of the method they call, so timers that
+        # call anything else can't be carried over.
+        now = time.time()
+        state["timers"] = [
+                (max(ts - now, 0), callback.__name__, focus) for
+                ts, timer, focus, callback in self.timers if
+                getattr(self, callback.__name__, None) == callback]
+        return state
+
+    def set_state(self, state):
+        super(Animat, self).set_state(state)
+        self.layer = state["layer"]
+        self.image = state["image"]
+        self.view = state["view"]
+        self.speed = state["speed"]
+
+        # Replace the timers that were armed when the entity was created.
+        self.deschedule_all()
+        self.timers = []
+        for seconds, name, focus in state["timers"]:
+            self.schedule(seconds, getattr(self, name), focus)
+
+        if any(state["velocity"]):
+            self.move(*state["velocity"], broadcast=False)
+
     def schedule(self, seconds, callback=None, focus=None):
         if not callback:
             callback = self._on_event
 
-        ts = int(time.time()) + seconds
+        ts = time.time() + seconds
 
         # Provide a means of cleaning up the timer list.
         def callback_wrapper():
@@ -281,16 +356,16 @@ class Animat(Entity):
         timer.start()
 
         index = 0
-        for t_ts, t_timer, t_focus in self.timers:
+        for t_ts, t_timer, t_focus, t_callback in self.timers:
             index += 1
             if t_ts < ts:
-                self.timers.insert(index, (ts, timer, focus))
+                self.timers.insert(index, (ts, timer, focus, callback))
                 return
-        self.timers.append((ts, timer, focus))
+        self.timers.append((ts, timer, focus, callback))
 
     def deschedule_all(self):
         """Deschedule all of the events in the timer queue."""
-        for t_ts, t_timer, t_focus in self.timers:
+        for t_ts, t_timer, t_focus, t_callback in self.timers:
             t_timer.cancel()
 
     def _on_event(self):
@@ -356,6 +431,10 @@ class Animat(Entity):
 
         if scheduled and should_redirect:
             self.move(*should_redirect, event=False)
+        elif now_moving and get_cell(self.position) != self.broadcast_cell:
+            # Clients only hear about the cells around them, so the ones that
+            # the animat is moving into view of need to be told about it.
+            self.broadcast_changes(*self._movement_properties)
         elif now_moving:
             # We're moving, didn't stop, and didn't hit a wall.
             for entity in self.location.entities:
@@ -471,17 +550,17 @@ class Animat(Entity):
             self.broadcast_changes(*self._movement_properties)
 
     def wander(self):
-        def callback():
-            best_direction = self._get_best_direction()
-            if not best_direction:
-                return
-            self.move(*best_direction)
-            self.wandering = True
-            self.schedule(random.randint(1, 4), self.stop_wandering)
-
         # Move the callback into the future so we can finish initializing the
         # entity.
-        self.schedule(0.25, callback)
+        self.schedule(0.25, self._start_wandering)
+
+    def _start_wandering(self):
+        best_direction = self._get_best_direction()
+        if not best_direction:
+            return
+        self.move(*best_direction)
+        self.wandering = True
+        self.schedule(random.randint(1, 4), self.stop_wandering)
 
     def stop_wandering(self):
         self.move(0, 0)
@@ -1,5 +1,3 @@
-import random
-
 from npc import NPC
 
 
@@ -7,10 +5,10 @@ HOMELY_IMAGES = ["old_woman1", "old_woman2", "homely1", "homely2"]
 
 class Homely(NPC):
 
-    def __init__(self, *args):
-        super(Homely, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(Homely, self).__init__(*args, **kwargs)
         self.talking = False
-        self.image = random.choice(HOMELY_IMAGES)
+        self.image = self.rng.choice(HOMELY_IMAGES)
 
         self.speed = 0.7
 
@@ -14,6 +14,18 @@ class ItemEntity(Entity):
     def get_prefix(self):
         return "!!"
 
+    def get_state(self):
+        state = super(ItemEntity, self).get_state()
+        state["item_code"] = self.item_code
+        return state
+
+    @classmethod
+    def restore(cls, location, state):
+        x, y = state["position"]
+        entity = cls(state["item_code"], x, y, location)
+        entity.set_state(state)
+        return entity
+
     def on_player_range(self, guid, distance):
         if distance >= 1 or guid.startswith("%"):
             return
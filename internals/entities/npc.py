@@ -9,8 +9,8 @@ from sentient import SentientAnimat
 class NPC(AnimatSprite, SentientAnimat, MarkovBot):
     """A non-playable character."""
 
-    def __init__(self, *args):
-        super(NPC, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(NPC, self).__init__(*args, **kwargs)
 
         self.schedule(self._unexpected_time())
         self.image = "npc"
@@ -29,6 +29,15 @@ class NPC(AnimatSprite, SentientAnimat, MarkovBot):
     def get_prefix(self):
         return "@"
 
+    def get_state(self):
+        state = super(NPC, self).get_state()
+        state["talking"] = self.talking
+        return state
+
+    def set_state(self, state):
+        super(NPC, self).set_state(state)
+        self.talking = state["talking"]
+
     def _unexpected_time(self):
         return random.randint(5, 12)
 
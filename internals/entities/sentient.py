@@ -57,6 +57,17 @@ class SentientAnimat(Harmable, Animat):
         if self.chasing == guid:
             self.chasing = None
 
+    def get_state(self):
+        state = super(SentientAnimat, self).get_state()
+        state["fleeing"] = list(self.fleeing)
+        state["chasing"] = self.chasing
+        return state
+
+    def set_state(self, state):
+        super(SentientAnimat, self).set_state(state)
+        self.fleeing = set(state["fleeing"])
+        self.chasing = state["chasing"]
+
     def flee(self, guid):
         """Mark a GUID as an entity to avoid."""
         if guid in self.fleeing:
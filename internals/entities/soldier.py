@@ -14,7 +14,7 @@ class Soldier(NPC):
         super(Soldier, self).__init__(*args, **kwargs)
         self.disable_chatbot = True
         self.talking = False
-        self.image = "soldier%d" % random.randint(1, 3)
+        self.image = "soldier%d" % self.rng.randint(1, 3)
 
         self.speed = 1.25
 
@@ -33,6 +33,15 @@ class Soldier(NPC):
     def get_prefix(self):
         return "%ssoldier_" % super(Soldier, self).get_prefix()
 
+    def get_state(self):
+        state = super(Soldier, self).get_state()
+        state["chase_queue"] = self._chase_queue
+        return state
+
+    def set_state(self, state):
+        super(Soldier, self).set_state(state)
+        self._chase_queue = list(state["chase_queue"])
+
     def _get_unexpected_time(self):
         return random.randint(2, 4)
 
@@ -4,8 +4,8 @@ from internals.levelbuilder.towns import ROAD_MATERIAL
 
 class Trader(NPC):
 
-    def __init__(self, *args):
-        super(Trader, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(Trader, self).__init__(*args, **kwargs)
         self.messages = ["What're ya buyin?", "Greetings, stranger!",
                          "Come back anytime.",
                          "Got somethin' that might interest ya. Heh heh heh!"]
@@ -3,19 +3,17 @@ import random
 import multiprocessing
 import os
 import threading
-
-import redis
+import time
 
 import internals.constants as constants
+import internals.entities as entities
 import internals.entities.items as items
 from internals.entities.entities import Animat
+from internals.interest import tag
 from internals.locations import Location
-
-
-redis_host, port = constants.redis.split(":")
-
-MESSAGES_TO_IGNORE = ("spa", "epu", )
-MESSAGES_TO_INSPECT = ("del", "cha", )
+from internals.partitions import connect, get_endpoint
+from internals.registry import LocationRegistry
+from internals.sharding import NODE_CHANNEL, SERVLET_LOAD
 
 
 class EntityServlet(multiprocessing.Process):
@@ -24,45 +22,153 @@ class EntityServlet(multiprocessing.Process):
     single location.
     """
 
-    def __init__(self, location, message_data=None):
+    def __init__(self, location=None, message_data=None, snapshot=None,
+                 pending_enters=(), node_id=None):
         super(EntityServlet, self).__init__()
 
-        self.location = Location(location)
+        self.node_id = node_id
+
+        # A servlet may be forked before it knows which location it will
+        # manage. In that case, it waits on this pipe for an assignment.
+        self._assignment, self._assigner = multiprocessing.Pipe(False)
+
+        self.location = Location(location) if location else None
         self._initial_message_data = message_data
+        # Set when this servlet is taking over a location from another node.
+        self._snapshot = snapshot
+        self._pending_enters = list(pending_enters)
 
         self.entities = []
         self.players = set()
+        # Moving players mapped to their last known position and velocity and
+        # when we heard about it.
+        self.player_motion = {}
         self.ttl = None
+        self.ttl_expires = None
+
+        self._last_load_sample = None
+
+    def assign(self, location, message_data=None, snapshot=None,
+               pending_enters=()):
+        """
+        Hand a location to a servlet that was started without one. This is
+        called from the parent process.
+        """
+        self.location = Location(location)
+        self._assigner.send((location, message_data, snapshot,
+                             list(pending_enters)))
+
+    def _wait_for_assignment(self):
+        """
+        Block until the parent process assigns a location to this servlet.
+        Everything that can happen before the location is known (imports,
+        tile parsing, Redis connections) has already happened by this point.
+        """
+        (location, self._initial_message_data, self._snapshot,
+         self._pending_enters) = self._assignment.recv()
+        self.location = Location(location)
 
     def _setup(self):
-        redis_host, port = constants.redis.split(":")
-        self.outbound_redis = redis.Redis(host=redis_host, port=int(port))
+        self.global_redis = connect(constants.redis)
+        self.global_redis.ping()
+        self.registry = LocationRegistry(self.global_redis, None)
+
+        if self.location is None:
+            self._wait_for_assignment()
 
-        if self._initial_message_data:
+        # The location's channels live on the Redis instance that it's
+        # partitioned onto.
+        self.endpoint = get_endpoint(self.location)
+        self.outbound_redis = connect(self.endpoint)
+
+    def _start_location(self):
+        """
+        Bring the location up: resume it from a snapshot, let in the player
+        who caused it to be started, or prewarm it.
+        """
+        if self._snapshot:
+            self.restore(json.loads(self._snapshot))
+            self._snapshot = None
+            for message_data in self._pending_enters:
+                self.on_enter(message_data)
+            self._pending_enters = []
+            self.registry.end_migration(self.location)
+        elif self._initial_message_data:
             self.on_enter(self._initial_message_data, initial=True)
             self._initial_message_data = None
+        else:
+            self._prewarm()
 
-    def _end(self):
+        self._report_load()
+        self._extrapolate_players()
+
+    def _prewarm(self):
+        """
+        Get the location ready for a player who is about to enter it. If
+        nobody does, it's cleaned up like any other empty location.
+        """
+        print "Prewarming %s" % self.location
+        if self.location.has_entities():
+            self.spawn_initial_entities(self.location)
+        self._schedule_cleanup(constants.prewarm_timeout)
+
+    def _stop(self, notify=True):
+        """Stop all activity in the location without exiting the process."""
         # Cancel any TTL timer.
         if self.ttl:
             self.ttl.cancel()
 
         # Destroy entities that still exist.
         for entity in self.entities:
-            entity.destroy()
+            entity.dead = True
+            entity.destroy(notify=notify)
+        self.entities = []
+
+        self.global_redis.hdel(SERVLET_LOAD, str(self.location))
 
-        self.terminate()
+    def _end(self):
+        self._stop()
+        self.registry.release(str(self.location), self.node_id)
+
+        # This is called from the TTL timer's thread, so the main thread is
+        # still blocked on Redis.
+        os._exit(0)
+
+    def _report_load(self):
+        """
+        Periodically publish the share of a CPU core that this servlet has used
+        since the last report. The balancer uses this to decide which
+        locations to migrate.
+        """
+        times = os.times()
+        sample = times[0] + times[1], time.time()
+        if self._last_load_sample:
+            cpu = ((sample[0] - self._last_load_sample[0]) /
+                   max(sample[1] - self._last_load_sample[1], 0.001))
+            self.global_redis.hset(SERVLET_LOAD, str(self.location),
+                                   "%s:%.3f" % (self.node_id, cpu))
+        self._last_load_sample = sample
+
+        t = threading.Timer(constants.servlet_metrics_period,
+                            self._report_load)
+        t.daemon = True
+        t.start()
 
     def run(self):
 
         self._setup()
 
-        inbound_redis = redis.Redis(host=redis_host, port=int(port))
+        inbound_redis = connect(self.endpoint)
         pubsub = inbound_redis.pubsub()
-        pubsub.subscribe("global::enter")
-        pubsub.subscribe("global::drop")
-        pubsub.subscribe("location::p::%s" % self.location)
-        pubsub.subscribe("location::pe::%s" % self.location)
+        # Player input; entities' own messages never come back to us.
+        pubsub.subscribe("location::i::%s" % self.location)
+        # Messages that the entity server directs at this servlet. The entity
+        # server forwards players to the servlet as soon as it's assigned, so
+        # this has to be subscribed to before the location is started.
+        control_channel = "location::c::%s" % self.location
+        pubsub.subscribe(control_channel)
+
+        self._start_location()
 
         for event in pubsub.listen():
             if event["type"] != "message":
@@ -70,31 +176,56 @@ class EntityServlet(multiprocessing.Process):
 
             message = event["data"]
             location, full_message_data = message.split(">", 1)
-            if (event["channel"] == "global::enter" and
-                location == str(self.location)):
-                self.on_enter(full_message_data)
+            if event["channel"] == control_channel:
+                message_type = full_message_data[:3]
+                message_data = full_message_data[3:]
+                if message_type == "ent":
+                    self.on_enter(message_data)
+                elif message_type == "dro":
+                    self.spawn_drop(message_data)
+                elif message_type == "mig":
+                    self.migrate(message_data)
+                    return
                 continue
-            if (event["channel"] == "global::drop" and
-                location == str(self.location)):
-                self.spawn_drop(full_message_data)
-                continue
-
-            message_type = full_message_data[:3]
-            message_data = full_message_data[3:]
 
-            if (message_type in MESSAGES_TO_IGNORE or
-                (message_type in MESSAGES_TO_INSPECT and
-                 message_data.startswith("@"))):
-                continue
-            if message_type == "del":
+            if full_message_data.startswith("del"):
                 # We don't need to split message_data because it's only one
                 # value.
-                self.on_leave(message_data)
+                self.on_leave(full_message_data[3:])
+            elif full_message_data.startswith("loc"):
+                self._track_player(full_message_data[3:])
 
             # TODO: Event handling code goes here.
             for entity in self.entities:
                 entity.handle_message(full_message_data)
 
+    def _track_player(self, message_data):
+        guid, x, y, x_vel, y_vel = message_data.split(":")[:5]
+        if x_vel == "0" and y_vel == "0":
+            self.player_motion.pop(guid, None)
+            return
+        self.player_motion[guid] = (int(x), int(y), int(x_vel), int(y_vel),
+                                    time.time())
+
+    def _extrapolate_players(self):
+        """
+        Periodically tell entities where moving players should be by now.
+        Players' web servers only publish their positions while they're moving
+        if they stray from this.
+        """
+        now = time.time()
+        for guid, motion in self.player_motion.items():
+            x, y, x_vel, y_vel, then = motion
+            travelled = (now - then) * 1000 * constants.speed
+            x, y = x + x_vel * travelled, y + y_vel * travelled
+            for entity in self.entities:
+                entity._player_movement(guid, x, y)
+
+        t = threading.Timer(constants.dead_reckoning_period,
+                            self._extrapolate_players)
+        t.daemon = True
+        t.start()
+
     def on_enter(self, message_data, initial=False):
         """
         When a player enters a level, test whether we need to spawn some
@@ -120,6 +251,49 @@ class EntityServlet(multiprocessing.Process):
         # TODO: Move this responsibility to the web server and just keep a copy
         # of the entity data in Redis.
 
+    def snapshot(self):
+        """
+        Return a JSON-serializable description of everything running in the
+        location. Entities carry their pending timers with them, so they pick
+        up their behaviors where they left off.
+        """
+        ttl = None
+        if self.ttl:
+            ttl = max(self.ttl_expires - time.time(), 0)
+
+        return {"entities": [entity.get_state() for entity in self.entities],
+                "players": list(self.players),
+                "ttl": ttl}
+
+    def restore(self, snapshot):
+        """Resume a location from the output of snapshot()."""
+        print "Restoring %d entities at %s" % (len(snapshot["entities"]),
+                                               self.location)
+        for state in snapshot["entities"]:
+            entity_type = getattr(entities, state["type"])
+            self.entities.append(entity_type.restore(self, state))
+
+        self.players = set(snapshot["players"])
+        if snapshot["ttl"] is not None and not self.players:
+            self._schedule_cleanup(snapshot["ttl"])
+
+    def migrate(self, node):
+        """
+        Freeze the location and hand it to another entity node. Ownership is
+        moved before the snapshot is published so that players who enter
+        during the handoff are held by the new owner until it has resumed.
+        """
+        print "Migrating %s to %s" % (self.location, node)
+
+        snapshot = self.snapshot()
+        self._stop(notify=False)
+
+        location = str(self.location)
+        self.registry.start_migration(location, node)
+        self.global_redis.publish(
+                NODE_CHANNEL % node,
+                "%s>ado%s" % (location, json.dumps(snapshot)))
+
     def on_leave(self, user):
         """
         If there are other players in the level, no worries. Detach any events
@@ -133,18 +307,22 @@ class EntityServlet(multiprocessing.Process):
             entity.forget(user)
 
         self.players.discard(user)
+        self.player_motion.pop(user, None)
         if not self.players:
             print "Last player left %s, preparing for cleanup." % self.location
+            self._schedule_cleanup(constants.entity_despawn_time)
 
-            def cleanup():
-                print "Cleaning up mobs at %s" % self.location
-                return self._end()
+    def _schedule_cleanup(self, delay):
+        def cleanup():
+            print "Cleaning up mobs at %s" % self.location
+            return self._end()
 
-            # This timer is allowed because it shouldn't be able to be thread
-            # unsafe.
-            t = threading.Timer(constants.entity_despawn_time, cleanup)
-            self.ttl = t
-            t.start()
+        # This timer is allowed because it shouldn't be able to be thread
+        # unsafe.
+        t = threading.Timer(delay, cleanup)
+        self.ttl = t
+        self.ttl_expires = time.time() + delay
+        t.start()
 
     def destroy_entity(self, entity):
         """Destroy an entity and remove it from the fork."""
@@ -158,10 +336,12 @@ class EntityServlet(multiprocessing.Process):
         """
         print "Spawning mobs at %s" % self.location
         spawn_entities = self.location.get_entities_to_spawn()
+        # Entities are placed the same way every time the location starts.
+        rng = random.Random(str(self.location))
 
         for entity in spawn_entities:
             # Initialize the new entity.
-            e = entity(self)
+            e = entity(self, rng=rng)
 
             level = self.location.generate()
             placeable_locations = e.get_placeable_locations(*level[:2])
@@ -174,10 +354,10 @@ class EntityServlet(multiprocessing.Process):
             elif not placeable_locations:
                 # The entity can be placed anywhere.
                 width, height = self.location.width(), self.location.height()
-                x = random.randint(int(0.1 * width), int(0.9 * width))
-                y = random.randint(int(0.1 * height), int(0.9 * height))
+                x = rng.randint(int(0.1 * width), int(0.9 * width))
+                y = rng.randint(int(0.1 * height), int(0.9 * height))
             else:
-                x, y = random.choice(placeable_locations)
+                x, y = rng.choice(placeable_locations)
 
             print "  > %s at (%d, %d)" % (str(entity), x, y)
 
@@ -197,11 +377,16 @@ class EntityServlet(multiprocessing.Process):
         self.entities.append(entity)
         self.spawn_entity(entity)
 
-    def notify_location(self, command, message, to_entities=False):
-        """A shortcut for broadcasting a message to the location."""
+    def notify_location(self, command, message, to_entities=False,
+                        position=None):
+        """
+        A shortcut for broadcasting a message to the location. If position is
+        set, only clients near that position will receive the message.
+        """
         self.outbound_redis.publish(
-                "location::e::%s" % self.location,
-                "%s>%s%s" % (self.location, command, message))
+                "location::r::%s" % self.location,
+                "%s>%s%s" % (tag(self.location, position, command), command,
+                             message))
 
         if to_entities:
             full_message = "%s%s" % (command, message)
@@ -0,0 +1,128 @@
+"""
+Generates levels in a pool of processes so that the IOLoop isn't held up by
+it. A level is generated once per web worker; the result is kept both as the
+Location's terrain (for portals and sliding) and in the level cache (for the
+"lev" message and /level/).
+"""
+
+import collections
+import multiprocessing
+import os
+import traceback
+
+import tornado.ioloop
+
+import internals.constants as constants
+import internals.levelcache as levelcache
+from internals.locations import Location
+import internals.metrics as metrics
+
+
+# This gets set by start(). Without a pool, levels are generated inline.
+pool = None
+
+# Content codes mapped to the callbacks that are waiting for them.
+_waiting = {}
+
+# Content codes mapped to the (terrain, hitmap, portals) that were generated
+# for them, least recently used first.
+_generated = collections.OrderedDict()
+
+
+def _close_inherited(fds):
+    """Close the file descriptors that a pool process inherited."""
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def start(processes=constants.generation_processes, sockets=()):
+    """
+    Start the generation pool. This must be done before any connections are
+    made so that the pool's processes don't share them. Sockets that are
+    already open (e.g., listening sockets bound before the web workers were
+    forked) are passed as `sockets`, and are closed in the pool's processes.
+    """
+    global pool
+    if processes:
+        pool = multiprocessing.Pool(
+                processes, initializer=_close_inherited,
+                initargs=([sock.fileno() for sock in sockets], ))
+
+
+def _generate(code):
+    """Generate a level. This is run in the pool's processes."""
+    try:
+        location = Location(code)
+        return location.generate(), levelcache.build(location, code)
+    except Exception:
+        # Exceptions don't make it back through apply_async's callback.
+        return None, traceback.format_exc()
+
+
+def _store(code, generated, level):
+    _generated[code] = generated
+    if len(_generated) > constants.level_cache_size:
+        _generated.popitem(last=False)
+    levelcache.store(code, level)
+
+
+def prime(location):
+    """
+    Give a Location the terrain that was generated for it, if there is any.
+    Return whether there was.
+    """
+    code = levelcache.content_code(location)
+    generated = _generated.pop(code, None)
+    if generated is None or not levelcache.has_level(code):
+        return False
+
+    _generated[code] = generated
+    (location._terrain_cache, location._hitmap_cache,
+     location._portal_cache) = generated
+    return True
+
+
+def _finish(code, result):
+    generated, level = result
+    waiting = _waiting.pop(code, [])
+    if generated is None:
+        metrics.incr("generation.failed")
+        print "Could not generate %s:\n%s" % (code, level)
+    else:
+        _store(code, generated, level)
+    for location, callback in waiting:
+        callback(prime(location))
+
+
+def load(location, callback):
+    """
+    Make sure that a location is generated, then call `callback` on the
+    IOLoop with whether it could be. Requests for a location that is already
+    being generated wait for the same result.
+    """
+    if prime(location):
+        callback(True)
+        return
+
+    code = levelcache.content_code(location)
+    if code in _waiting:
+        metrics.incr("generation.joined")
+        _waiting[code].append((location, callback))
+        return
+    _waiting[code] = [(location, callback)]
+    metrics.incr("generation.started")
+
+    if pool is None:
+        _finish(code, _generate(code))
+        return
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    def on_result(result):
+        # This is called from one of the pool's threads.
+        io_loop.add_callback(lambda: _finish(code, result))
+
+    pool.apply_async(_generate, (code, ), callback=on_result)
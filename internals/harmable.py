@@ -45,6 +45,15 @@ class Harmable(object):
 
         self.harm(damage)
 
+    def get_state(self):
+        state = super(Harmable, self).get_state()
+        state["health"] = self.health
+        return state
+
+    def set_state(self, state):
+        super(Harmable, self).set_state(state)
+        self.health = state["health"]
+
     def heal(self, health):
         """Heal the entity with a particular amount of health."""
         self.health = min(self.health + health, 100)
@@ -0,0 +1,43 @@
+import internals.constants as constants
+from internals.partitions import get_redis
+
+
+def population(location):
+    """Return the number of players in a location, across all web workers."""
+    return get_redis(location).scard("l:c:%s" % location)
+
+
+def choose_instance(location):
+    """
+    Return the code of the instance of `location` that a new arrival should
+    be placed in. Arrivals fill the lowest instance that has room, so higher
+    instances empty out as the population falls.
+    """
+    if not constants.instance_capacity:
+        return str(location)
+
+    instance = 0
+    while True:
+        code = location.get_instance_code(instance)
+        if population(code) < constants.instance_capacity:
+            return code
+        instance += 1
+
+
+def merge_target(location):
+    """
+    Return the code of a lower instance that the players in `location` could
+    all be moved to, or None if the instance should be left alone.
+    """
+    if not location.instance:
+        return None
+
+    remaining = population(location)
+    if remaining > constants.instance_merge_size:
+        return None
+
+    for instance in range(location.instance):
+        code = location.get_instance_code(instance)
+        if population(code) + remaining <= constants.instance_capacity:
+            return code
+    return None
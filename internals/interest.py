@@ -0,0 +1,129 @@
+import internals.constants as constants
+from internals.outbound import merge_updates
+
+
+CELL_PIXELS = constants.interest_cell_size * constants.tilesize
+HYSTERESIS_PIXELS = constants.interest_hysteresis * constants.tilesize
+
+# Headers that start with this mark messages that are relayed to clients
+# untouched (see constants.RELAY_MESSAGES).
+RELAY_MARK = "*"
+
+
+def get_cell(position):
+    """Return the cell containing a position (in pixels)."""
+    x, y = position
+    return int(x // CELL_PIXELS), int(y // CELL_PIXELS)
+
+
+def tag(location, position=None, message_type=None):
+    """
+    Build the header for a message published to a location. If `position` is
+    set, the header includes the cell that it falls in. If `message_type` is
+    one that web nodes relay without reading, the header is marked as such.
+    """
+    if position is None:
+        header = str(location)
+    else:
+        header = "%s#%d:%d" % ((location, ) + get_cell(position))
+
+    if message_type in constants.RELAY_MESSAGES:
+        return RELAY_MARK + header
+    return header
+
+
+def in_range(cell, center):
+    """Return whether a cell is within interest_radius cells of another."""
+    return (abs(cell[0] - center[0]) <= constants.interest_radius and
+            abs(cell[1] - center[1]) <= constants.interest_radius)
+
+
+def split_header(header):
+    """
+    Split a message header into the location and the cell that the message is
+    tagged with. The cell is None for untagged messages.
+    """
+    if "#" not in header:
+        return header, None
+    location, cell = header.split("#", 1)
+    x, y = cell.split(":")
+    return location, (int(x), int(y))
+
+
+class InterestArea(object):
+    """
+    Tracks the cell that a client is centered on. The client only moves to a
+    new cell once it's more than constants.interest_hysteresis tiles past the
+    border of its current one, so walking along a border doesn't cause the set
+    of visible cells to flap.
+    """
+
+    def __init__(self, position=None):
+        self.cell = None
+        if position is not None:
+            self.reset(position)
+
+    def reset(self, position):
+        """Center the area on a position, ignoring hysteresis."""
+        self.cell = get_cell(position)
+
+    def update(self, position):
+        """
+        Move the area if the position has left the current cell. Returns
+        whether the area moved.
+        """
+        if self.cell is None:
+            self.reset(position)
+            return False
+
+        x, y = position
+        left = self.cell[0] * CELL_PIXELS - HYSTERESIS_PIXELS
+        top = self.cell[1] * CELL_PIXELS - HYSTERESIS_PIXELS
+        right = (self.cell[0] + 1) * CELL_PIXELS + HYSTERESIS_PIXELS
+        bottom = (self.cell[1] + 1) * CELL_PIXELS + HYSTERESIS_PIXELS
+        if not (left <= x < right and top <= y < bottom):
+            self.cell = get_cell(position)
+            return True
+        return False
+
+    def can_see(self, cell):
+        """Return whether messages tagged with `cell` should be delivered."""
+        if cell is None or self.cell is None:
+            return True
+        return in_range(cell, self.cell)
+
+
+class LastKnown(object):
+    """
+    The latest cell-tagged position and property updates for everything in a
+    location. Clients only hear about the cells around them, so when a
+    client's area moves, it's sent the updates for the cells that it can now
+    see. Otherwise, it would go on extrapolating from whatever it heard last.
+    """
+
+    def __init__(self):
+        # Entity and player IDs mapped to their latest "loc" and "epu"
+        # messages and the cells those were tagged with.
+        self.updates = {}
+
+    def record(self, message, cell):
+        m_type, guid = message[:3], message[3:].split(":", 1)[0]
+        key = m_type, guid
+        if m_type == "epu" and key in self.updates:
+            message = merge_updates(self.updates[key][1], message)
+        self.updates[key] = cell, message
+
+    def forget(self, guid):
+        """Drop the updates for something that has left the location."""
+        for m_type in constants.COLLAPSIBLE_MESSAGES:
+            self.updates.pop((m_type, guid), None)
+
+    def newly_visible(self, cell, old_cell):
+        """
+        Return the updates that are visible from `cell` but weren't from
+        `old_cell`.
+        """
+        return [message for (m_type, guid), (tagged, message) in
+                self.updates.items() if
+                in_range(tagged, cell) and
+                (old_cell is None or not in_range(tagged, old_cell))]
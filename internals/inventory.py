@@ -76,9 +76,8 @@ class InventoryManager(object):
         dx += (direction[0] * 3 + 0.5) * constants.tilesize
         dy += (direction[1] * 3 - 0.5) * constants.tilesize
 
-        self._notify_global("drop", "%s>%s:%s:%d:%d" % (str(self.location),
-                                                        self.id, item_code,
-                                                        dx, dy))
+        self._notify_owner(str(self.location),
+                           "dro%s:%s:%d:%d" % (self.id, item_code, dx, dy))
 
     def cycle_items(self, direction):
         """Cycle the items in the inventory one slot in `direction`"""
@@ -1,7 +1,6 @@
 import copy
 import math
 import random
-from random import randint
 
 import internals.entities as entities
 from internals.levelbuilder.tiles import get_building_tiles, overlay
@@ -16,11 +15,14 @@ MOVABLE_DIRECTIONS = ((0, 1), (1, 0), (0, -1), (-1, 0), )
 DUNGEON_SIZE = 28, 28
 
 
-def overlay_portal(grid, hitmap, location):
-    """Build the portal to a dungeon in a non-sublocation."""
+def overlay_portal(grid, hitmap, rng):
+    """
+    Build the portal to a dungeon in a non-sublocation, placing it with the
+    random number generator `rng`.
+    """
     width, height = DUNGEON_PORTAL[:2]
-    x = randint(3, len(grid[0]) - 3 - width)
-    y = randint(3, len(grid) - 3 - height)
+    x = rng.randint(3, len(grid[0]) - 3 - width)
+    y = rng.randint(3, len(grid) - 3 - height)
     grid, hitmap, raw_portals = overlay(grid, hitmap, DUNGEON_PORTAL, x, y)
     portals = []
     for raw_portal in raw_portals:
@@ -87,41 +89,51 @@ def build_dungeon(location):
     return grid, hitmap, portals
 
 
-def _get_room(location):
+def _get_room(location, rng=None):
     dungeon = _build_dungeon_layout(location)
     sublocation = location.sublocations[-1]
     x, y = sublocation[1]
-    offset_x, offset_y = get_offset(location)
+    offset_x, offset_y = get_offset(location, rng)
     x += offset_x
     y += offset_y
 
     return dungeon[y][x]
 
 
-def get_offset(location):
+def _get_random(location):
+    """Return a random number generator seeded for a location's dungeon."""
     location_x, location_y = location.coords
-    random.seed(location_x + 1 / (location_y + 0.5) +
-                len(location.sublocations) *
-                (2 if location.world == "e" else 1))
-    return randint(0, 5), randint(0,5)
+    return random.Random(location_x + 1 / (location_y + 0.5) +
+                         len(location.sublocations) *
+                         (2 if location.world == "e" else 1))
+
+
+def get_offset(location, rng=None):
+    """
+    Return the position of a dungeon's lobby in its layout. If `rng` is set,
+    it should be fresh from _get_random(); the offset is drawn from it.
+    """
+    if rng is None:
+        rng = _get_random(location)
+    return rng.randint(0, 5), rng.randint(0,5)
 
 
 def get_entities(location):
-    room = _get_room(location)
-    # No need to seed the random number generator, _get_room>get_offset does it
-    # for us :)
+    # The mobs are drawn from where finding the room leaves off.
+    rng = _get_random(location)
+    room = _get_room(location, rng)
 
     spawn = []
     if room["type"] in ("stairwell", "lobby", ):
         # These rooms don't have mobs.
         return []
     elif room["type"] == "room":
-        for i in range(randint(0, 4)):
+        for i in range(rng.randint(0, 4)):
             spawn.append(entities.Zombie)
     elif room["type"] == "mob_drop":
-        for i in range(randint(0, 2)):
+        for i in range(rng.randint(0, 2)):
             spawn.append(entities.DeathWaker)
-        for i in range(randint(2, 4)):
+        for i in range(rng.randint(2, 4)):
             spawn.append(entities.Zombie)
     elif room["type"] == "angel":
         spawn.append(entities.FallenAngel)
@@ -134,16 +146,18 @@ def _build_dungeon_layout(location):
     Build the layout for a dungeon based on the location of its portal in a
     non-sublocation.
 
-    This function is seeded by the get_offset function.
+    The layout is drawn from where get_offset() leaves off.
     """
 
     if location._dungeon_cache:
         return location._dungeon_cache
 
+    rng = _get_random(location)
     # Offset: position of starting location from top left of dungeon grid.
-    offset_x, offset_y = get_offset(location)
+    offset_x, offset_y = get_offset(location, rng)
     # Width: size of the dungeon grid.
-    width_x, width_y = randint(2, 5) + offset_x, randint(2, 5) + offset_y
+    width_x, width_y = (rng.randint(2, 5) + offset_x,
+                        rng.randint(2, 5) + offset_y)
     x, y = location.sublocations[-1][1]
     x += offset_x
     y += offset_y
@@ -190,19 +204,19 @@ def _build_dungeon_layout(location):
         if initial:
             room["type"] = "lobby"
         else:
-            room_type = random.choice(ROOM_TYPES)
+            room_type = rng.choice(ROOM_TYPES)
             room["type"] = room_type
 
         # We use a generator comprehension so we don't have to use while loops.
         random_directions = list(MOVABLE_DIRECTIONS)
-        random.shuffle(random_directions)
+        rng.shuffle(random_directions)
         # Filter out all of the directions that we can't go to.
         directions = [direction for direction in random_directions if
                       can_move(x, y, direction[0], direction[1])]
         # Randomly include only a subset of the directions.
         dir_count = len(directions)
         if not initial:
-            directions = directions[:randint(min(1, dir_count), dir_count)]
+            directions = directions[:rng.randint(min(1, dir_count), dir_count)]
         room["outbound_passages"] = dir_count
 
         for direction in directions:
@@ -220,7 +234,7 @@ def _build_dungeon_layout(location):
 
     rooms_to_process.append((offset_x, offset_y))
     while rooms_to_process:
-        next_room = random.choice(rooms_to_process)
+        next_room = rng.choice(rooms_to_process)
         rooms_to_process.remove(next_room)
         _build_room(*next_room)
 
@@ -233,13 +247,13 @@ def _build_dungeon_layout(location):
     # Give a bunch of the terminal rooms some stuff.
     special_rooms = ["boss", "angel"]
     for sp_room in special_rooms:
-        room = random.choice(terminal_rooms)
+        room = rng.choice(terminal_rooms)
         terminal_rooms.remove(room)
         room["type"] = sp_room
 
     # Decide whether there should be a stairwell.
-    if randint(0, 1):
-        room = random.choice(terminal_rooms)
+    if rng.randint(0, 1):
+        room = rng.choice(terminal_rooms)
         terminal_rooms.remove(room)
         room["type"] = "stairwell"
 
@@ -1,7 +1,6 @@
 from copy import deepcopy
 from math import floor
 import os
-import random
 
 from internals.constants import level_width, level_height
 from tiles import get_building_tiles, overlay
@@ -68,8 +67,11 @@ def smooth_roads(grid):
     return grid
 
 
-def build_town(grid, hitmap, seed=0):
-    """Run the town building algorithm on a tile grid."""
+def build_town(grid, hitmap, rng):
+    """
+    Run the town building algorithm on a tile grid, drawing from the random
+    number generator `rng`.
+    """
 
     # The future home of portals generated by building placement.
     portals = []
@@ -82,7 +84,7 @@ def build_town(grid, hitmap, seed=0):
 
     available_buildings = list(BUILDINGS)
 
-    center = random.choice(TOWN_CENTERS)
+    center = rng.choice(TOWN_CENTERS)
     center_entity = BUILDING_ENTITIES[center]
 
     midpoint_x, midpoint_y = floor(level_width / 2), floor(level_height / 2)
@@ -101,7 +103,7 @@ def build_town(grid, hitmap, seed=0):
 
     available_buildings.remove(center)
 
-    building_limit = random.randint(6, 15)
+    building_limit = rng.randint(6, 15)
     building_count = 0
 
     # The internal position is represented with a point that's located
@@ -152,7 +154,7 @@ def build_town(grid, hitmap, seed=0):
             widest_building = 0
             building_w, building_h = 0, 0
             while not border_conds[direction]():
-                building = random.choice(available_buildings)
+                building = rng.choice(available_buildings)
                 if building not in REPEATABLE_BUILDINGS:
                     available_buildings.remove(building)
 
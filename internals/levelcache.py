@@ -0,0 +1,95 @@
+import collections
+import gzip
+import hashlib
+import json
+import StringIO
+
+import internals.constants as constants
+from internals.levelcodec import encode_content
+from internals.locations import Location
+
+
+# `content` is the JSON of the parts of a level that are the same for every
+# player, with the terrain and hitmap in the compact encoding. `gzipped` is
+# the same, compressed (or None if constants.level_gzip is off), and `header`
+# is the start of the level's "lev" message.
+CachedLevel = collections.namedtuple("CachedLevel",
+                                     "hash content gzipped header")
+
+# Location codes mapped to their CachedLevels, least recently used first.
+_levels = collections.OrderedDict()
+
+
+def content_code(location):
+    """
+    Return the code that a location's content is stored under. Every
+    instance of a location has the same content.
+    """
+    return location.get_instance_code(0)
+
+
+def _gzip(data):
+    compressed = StringIO.StringIO()
+    # The timestamp is fixed so that the output only depends on the data.
+    with gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return compressed.getvalue()
+
+
+def build(location, code):
+    """Build the CachedLevel for a location, stored under `code`."""
+    content = json.dumps(encode_content(location.content()))
+    content_hash = hashlib.md5(
+            "%d:%s" % (constants.level_version, content)).hexdigest()
+    gzipped = _gzip(content) if constants.level_gzip else None
+    header = 'lev{"code": %s, "version": %d, "hash": "%s", ' % (
+            json.dumps(code), constants.level_version, content_hash)
+    return CachedLevel(content_hash, content, gzipped, header)
+
+
+def get_level(location):
+    """
+    Return the CachedLevel for a location. `location` may be a Location or a
+    location code.
+    """
+    if not isinstance(location, Location):
+        location = Location(location)
+
+    code = content_code(location)
+    level = _levels.pop(code, None)
+    if level is None:
+        level = build(location, code)
+    store(code, level)
+    return level
+
+
+def has_level(code):
+    return code in _levels
+
+
+def store(code, level):
+    """Cache a CachedLevel, e.g., one that was built in another process."""
+    _levels.pop(code, None)
+    _levels[code] = level
+    if len(_levels) > constants.level_cache_size:
+        _levels.popitem(last=False)
+
+
+def level_message(location, avx, avy, health):
+    """
+    Build the "lev" message that tells a player to load a level. Only the
+    player's own fields are serialized; the rest comes from the cache.
+    """
+    return '%s"avatar": {"x": %s, "y": %s}, "health": %s}' % (
+            get_level(location).header, json.dumps(avx), json.dumps(avy),
+            json.dumps(health))
+
+
+def prefetch_message(location):
+    """
+    Build the "pre" message that tells a player to fetch a level's content
+    before they need it.
+    """
+    return 'pre{"code": %s, "version": %d, "hash": "%s"}' % (
+            json.dumps(content_code(location)), constants.level_version,
+            get_level(location).hash)
@@ -0,0 +1,106 @@
+"""
+A compact encoding for level content.
+
+Terrain is run-length encoded as (count, tile) byte pairs, reading the grid
+row by row, so runs can carry on from one row to the next. The hitmap is a
+bitset, one bit per tile, with the first tile in the most significant bit.
+Both are base64 encoded so they can travel as JSON strings. jgame.js has the
+matching decoder (jgutils.levels.decode).
+"""
+
+import array
+import base64
+
+
+# Stored in encoded content so that the format can change later.
+ENCODING = 1
+
+
+def encode_grid(grid):
+    """
+    Run-length encode a grid of tiles. Raises OverflowError if a tile doesn't
+    fit in a byte.
+    """
+    encoded = array.array("B")
+    run_tile, run_length = None, 0
+    for row in grid:
+        for tile in row:
+            if tile == run_tile and run_length < 255:
+                run_length += 1
+                continue
+            if run_length:
+                encoded.extend((run_length, run_tile))
+            run_tile, run_length = tile, 1
+    if run_length:
+        encoded.extend((run_length, run_tile))
+    return base64.b64encode(encoded.tostring())
+
+
+def decode_grid(data, width, height):
+    encoded = array.array("B", base64.b64decode(data))
+    tiles = []
+    for i in range(0, len(encoded), 2):
+        tiles.extend([encoded[i + 1]] * encoded[i])
+    return [tiles[y * width:(y + 1) * width] for y in range(height)]
+
+
+def encode_bits(grid):
+    """Encode a grid of zeroes and ones as a bitset."""
+    encoded = array.array("B")
+    byte, bits = 0, 0
+    for row in grid:
+        for cell in row:
+            byte = byte << 1 | cell
+            bits += 1
+            if bits == 8:
+                encoded.append(byte)
+                byte, bits = 0, 0
+    if bits:
+        encoded.append(byte << (8 - bits))
+    return base64.b64encode(encoded.tostring())
+
+
+def decode_bits(data, width, height):
+    encoded = array.array("B", base64.b64decode(data))
+    grid = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            bit = y * width + x
+            row.append(encoded[bit >> 3] >> (7 - (bit & 7)) & 1)
+        grid.append(row)
+    return grid
+
+
+def encode_content(content):
+    """
+    Return a copy of a level's content (see Location.content()) with its
+    terrain and hitmap encoded. If either can't be encoded, the content is
+    returned as it is.
+    """
+    if any(cell not in (0, 1) for row in content["hitmap"] for cell in row):
+        return content
+    try:
+        level = encode_grid(content["level"])
+    except OverflowError:
+        return content
+
+    encoded = dict(content)
+    encoded["level"] = level
+    encoded["hitmap"] = encode_bits(content["hitmap"])
+    encoded["encoding"] = ENCODING
+    return encoded
+
+
+def decode_content(content):
+    """Reverse encode_content()."""
+    if "encoding" not in content:
+        return content
+
+    decoded = dict(content)
+    del decoded["encoding"]
+    decoded["level"] = decode_grid(content["level"], content["w"],
+                                   content["h"])
+    decoded["hitmap"] = decode_bits(content["hitmap"], content["w"],
+                                    content["h"])
+    return decoded
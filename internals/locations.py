@@ -8,6 +8,8 @@ import levelbuilder.buildings as buildings
 from levelbuilder.levelbuilder import build_region
 import levelbuilder.dungeons as dungeons
 import levelbuilder.towns as towns
+import regionstore
+import terraincache
 
 
 class Location():
@@ -19,27 +21,34 @@ class Location():
 
         All location IDs must be in the following format:
 
-        <world>:<x>:<y>[:<sublocation>[:...]]
+        <world>[~<instance>]:<x>:<y>[:<sublocation>[:...]]
 
         A sublocation is defined as one of the following:
 
         - b:<x>:<y>:<building_type>
         - <sublocation_world_type>:<x>:<y>
+
+        Instances are copies of the same level that are run separately. A
+        location without an instance number is instance zero.
         """
         self.location_code = location_code
         scode = location_code.split(":")
         self.world = scode[0]
+        self.instance = 0
+        if "~" in self.world:
+            self.world, instance = self.world.split("~", 1)
+            self.instance = int(instance)
         self.coords = int(scode[1]), int(scode[2])
         self.sublocations = []
         scode = scode[3:]
 
-        self._dungeon_cache = None
-
         self._terrain_cache = None
         self._hitmap_cache = None
         self._portal_cache = []
 
+        # The layout of the dungeon that this location is in, if it's in one.
         self._dungeon_cache = None
+        self._is_dungeon_cache = None
         self._town_cache = None
 
         # Parse sublocation information.
@@ -53,6 +62,36 @@ class Location():
                 self.sublocations.append((subloc_type, coords, scode[3]))
                 scode = scode[4:]
 
+    def is_valid(self):
+        """
+        Return whether the location can be generated: its code is written
+        the way this class writes codes, it's within
+        constants.region_store_radius regions of the origin, and its
+        sublocations are of the kinds that its region has. Codes that come
+        from players should be checked with this before they're generated.
+        """
+        radius = constants.region_store_radius
+        x, y = self.coords
+        if not (-radius <= x < radius and -radius <= y < radius):
+            return False
+
+        sublocs = "".join(":%s" % self._reconstitute_sublocation(sublocation)
+                          for sublocation in self.sublocations)
+        if self.location_code != "%s:%d:%d%s" % (
+                (self._world_code(self.instance), ) + self.coords + (sublocs, )):
+            return False
+
+        if not self.sublocations:
+            return True
+        if self.is_town():
+            return (len(self.sublocations) == 1 and
+                    self.sublocations[0][0] == "b" and
+                    self.sublocations[0][2] in buildings.INTERIOR_ENTITIES)
+        if self.is_dungeon():
+            return all(sublocation[0] == "d" for
+                       sublocation in self.sublocations)
+        return False
+
     def _reconstitute_sublocation(self, x):
         build = []
         for item in x:
@@ -62,9 +101,15 @@ class Location():
                 build.append(str(item))
         return ":".join(build)
 
+    def _world_code(self, instance):
+        if not instance:
+            return self.world
+        return "%s~%d" % (self.world, instance)
+
     def get_slide_code(self, x, y):
         """
         Get the code for a location if the player slides in any direction.
+        Sliding within a sublocation keeps the player in the same instance.
         """
         if self.sublocations:
             sls = deepcopy(self.sublocations)
@@ -73,38 +118,70 @@ class Location():
             sls[-1] = last_sl
 
             build = ":".join(map(self._reconstitute_sublocation, sls))
-            return "%s:%d:%d:%s" % (self.world, self.coords[0], self.coords[1],
-                                    build)
+            return "%s:%d:%d:%s" % (self._world_code(self.instance),
+                                    self.coords[0], self.coords[1], build)
         else:
             return "%s:%d:%d" % (self.world, x, y)
 
+    def get_parent_code(self):
+        """Get the code for the location containing this sublocation."""
+        sublocs = map(self._reconstitute_sublocation, self.sublocations[:-1])
+        sublocs = ":%s" % ":".join(sublocs) if sublocs else ""
+        return "%s:%d:%d%s" % ((self._world_code(self.instance), ) +
+                               self.coords + (sublocs, ))
+
+    def get_instance_code(self, instance):
+        """Get the code for another instance of this location."""
+        scode = self.location_code.split(":")
+        scode[0] = self._world_code(instance)
+        return ":".join(scode)
+
+    def _town_seed(self):
+        return self.coords[0] * 1000 + self.coords[1]
+
+    def _dungeon_seed(self):
+        return self.coords[0] * 1001 + self.coords[1] * 2 + 1
+
+    def _town_random(self):
+        """
+        Return a random number generator in the state that deciding whether
+        the location is a town leaves it in. Towns and their inhabitants are
+        generated from there.
+        """
+        rng = random.Random(self._town_seed())
+        # The starting location is always a town, so nothing is drawn for it.
+        if self.coords != (0, 0):
+            rng.randint(0, 5)
+        return rng
+
+    def _dungeon_random(self):
+        """
+        Return a random number generator in the state that deciding whether
+        the location has a dungeon leaves it in. Dungeon portals and the
+        wildlife outside of dungeons are generated from there.
+        """
+        rng = random.Random(self._dungeon_seed())
+        # The location next to the starting location always has a dungeon.
+        if self.coords != (1, 0):
+            rng.randint(0, 5)
+        return rng
+
     def is_town(self):
-        if self._town_cache is not None:
-            return self._town_cache
-        random.seed(self.coords[0] * 1000 + self.coords[1])
-
-        # We need to seed before we test for forced towns because this also
-        # seeds the town generator.
-        if self.coords == (0, 0):
-            self._town_cache
-            return True
-        self._town_cache = random.randint(0, 5) == 0
+        if self._town_cache is None:
+            rng = random.Random(self._town_seed())
+            self._town_cache = (self.coords == (0, 0) or
+                                rng.randint(0, 5) == 0)
         return self._town_cache
 
     def is_dungeon(self):
-        if self._dungeon_cache is not None:
-            return self._dungeon_cache
-
-        if self.is_town():
-            self._dungon_cache = False
-            return False
-        random.seed(self.coords[0] * 1001 + self.coords[1] * 2 + 1)
-        if self.coords[0] == 1 and self.coords[1] == 0:
-            self._dungon_cache = True
-            return True
-
-        self._dungon_cache = random.randint(0, 5) == 0
-        return self._dungeon_cache
+        # The draw in _dungeon_random() was meant to place dungeons elsewhere
+        # too, but its result has never been used. Using it would change the
+        # world, so for now the only dungeon is the one next to the starting
+        # location.
+        if self._is_dungeon_cache is None:
+            self._is_dungeon_cache = (not self.is_town() and
+                                      self.coords == (1, 0))
+        return self._is_dungeon_cache
 
     def has_entities(self):
         return True
@@ -121,27 +198,29 @@ class Location():
         is_town = self.is_town()
         spawn = []
         if is_town and self.sublocations:
+            rng = self._town_random()
             # There's a 1/5 chance of a soldier being in a house
-            if random.randint(0, 4) > 2:
+            if rng.randint(0, 4) > 2:
                 spawn.append(entities.Soldier)
 
-            for i in range(random.randint(1, 3)):
+            for i in range(rng.randint(1, 3)):
                 spawn.append(entities.Homely)
 
-            for i in range(random.randint(0, 1)):
+            for i in range(rng.randint(0, 1)):
                 spawn.append(entities.Child)
 
         elif is_town:
             #return [entities.Bully]
-            for i in range(random.randint(0, 2)):
+            rng = self._town_random()
+            for i in range(rng.randint(0, 2)):
                 spawn.append(entities.Trader)
-            for i in range(random.randint(0, 4)):
+            for i in range(rng.randint(0, 4)):
                 spawn.append(entities.Child)
-            for i in range(random.randint(0, 2)):
+            for i in range(rng.randint(0, 2)):
                 spawn.append(entities.Bully)
 
             # Towns always have at least two soldiers.
-            for i in range(random.randint(2, 4)):
+            for i in range(rng.randint(2, 4)):
                 spawn.append(entities.Soldier)
         else:
             is_dungeon = self.is_dungeon()
@@ -150,9 +229,10 @@ class Location():
                 return dungeons.get_entities(self)
             else:
                 # Outside of the dungeon
-                for i in range(random.randint(2, 5)):
+                rng = self._dungeon_random()
+                for i in range(rng.randint(2, 5)):
                     spawn.append(entities.Sheep)
-                for i in range(random.randint(0, 3)):
+                for i in range(rng.randint(0, 3)):
                     spawn.append(entities.Wolf)
 
         return spawn
@@ -165,7 +245,19 @@ class Location():
             self._portal_cache is not None):
             return self._terrain_cache, self._hitmap_cache, self._portal_cache
 
-        # TODO: Generate the level if it doesn't already automatically exist.
+        # The world may have been pregenerated, or another process may have
+        # generated the level already.
+        code = self.get_instance_code(0)
+        if self.sublocations:
+            cached = regionstore.load_sublocation(self.world, code)
+        else:
+            cached = regionstore.load(self.world, *self.coords)
+        if cached is None:
+            cached = terraincache.load(code)
+        if cached is not None:
+            (self._terrain_cache, self._hitmap_cache,
+             self._portal_cache) = cached
+            return cached
 
         # Only generate the world-level region if we're not in a sublocation.
         tileset, level, hitmap = None, None, None
@@ -185,17 +277,18 @@ class Location():
             if self.sublocations[0][0] == "b":
                 level, hitmap, portals = buildings.build_interior(self)
         elif is_town:
-            # Already seeded by is_town method.
-            level, hitmap, portals = towns.build_town(level, hitmap)
+            level, hitmap, portals = towns.build_town(level, hitmap,
+                                                      self._town_random())
         elif is_dungeon and self.sublocations:
             level, hitmap, portals = dungeons.build_dungeon(self)
-        elif self.is_dungeon():
-            level, hitmap, portals = dungeons.overlay_portal(level, hitmap,
-                                                             self)
+        elif is_dungeon:
+            level, hitmap, portals = dungeons.overlay_portal(
+                    level, hitmap, self._dungeon_random())
 
         self._terrain_cache = level
         self._hitmap_cache = hitmap
         self._portal_cache = portals
+        terraincache.save(code, level, hitmap, portals)
 
         return level, hitmap, portals
 
@@ -224,15 +317,23 @@ class Location():
         else:
             return len(self.generate()[0][0])
 
-    def render(self, avx, avy):
-        """Render the JSON representation of the level."""
+    def get_coords(self):
+        """
+        Return the coordinates of the innermost region, i.e., the ones that
+        sliding changes.
+        """
+        if not self.sublocations:
+            return self.coords
+        return self.sublocations[-1][1]
 
-        level, hitmap, portals = self.generate()
+    def content(self):
+        """
+        Render the parts of the level's JSON representation that are the same
+        for every player.
+        """
 
-        if not self.sublocations:
-            x, y = self.coords
-        else:
-            x, y = self.sublocations[-1][1]
+        level, hitmap, portals = self.generate()
+        x, y = self.get_coords()
 
         return {
             "x": x,
@@ -242,10 +343,15 @@ class Location():
             "level": level,
             "hitmap": hitmap,
             "portals": portals,
-            "avatar": {"x": avx, "y": avy},
             "tileset": self.tileset(),
             "can_slide": self.can_slide(),
         }
 
+    def render(self, avx, avy):
+        """Render the JSON representation of the level."""
+        rendered = self.content()
+        rendered["avatar"] = {"x": avx, "y": avy}
+        return rendered
+
     def __str__(self):
         return self.location_code
@@ -0,0 +1,21 @@
+import collections
+
+
+# Counters of things that this process has done and gauges of its current
+# state, by name. web_server.py serves these at /metrics.
+counters = collections.defaultdict(int)
+gauges = {}
+
+
+def incr(name, amount=1):
+    counters[name] += amount
+
+
+def set_gauge(name, value):
+    gauges[name] = value
+
+
+def snapshot():
+    values = dict(counters)
+    values.update(gauges)
+    return values
@@ -0,0 +1,103 @@
+import collections
+import re
+
+import internals.constants as constants
+import internals.metrics as metrics
+
+
+# This separates the messages in a multi-message frame.
+FRAME_SEPARATOR = "\x1e"
+
+# Messages that add or remove an entity. Updates to the entity that are queued
+# before one of these mustn't absorb updates that come after it.
+LIFECYCLE_MESSAGES = ("add", "del", "spa", "die")
+
+
+def merge_updates(old, new):
+    """
+    Merge two entity property updates ("epu<id>:<key>=<value>\n...") into
+    one, keeping the newer value of any property that's in both.
+    """
+    header, old_body = old.split(":", 1)
+    new_body = new.split(":", 1)[1]
+
+    properties = collections.OrderedDict()
+    for line in old_body.split("\n") + new_body.split("\n"):
+        properties[line.split("=", 1)[0]] = line
+    return "%s:%s" % (header, "\n".join(properties.values()))
+
+
+def pack_frame(messages):
+    """
+    Pack several messages into one "mul" frame. The client splits the frame
+    on FRAME_SEPARATOR, so any in the messages themselves are removed.
+    """
+    return "mul%s" % FRAME_SEPARATOR.join(
+            message.replace(FRAME_SEPARATOR, "") for message in messages)
+
+
+class OutboundQueue(object):
+    """
+    Messages waiting to be written to a client whose socket is backed up.
+
+    Position and property updates for an entity that already has one queued
+    are merged into the queued one. Once the queue holds `limit` messages,
+    the oldest message that isn't in constants.RELIABLE_MESSAGES is dropped
+    to make room; reliable messages are queued regardless.
+    """
+
+    def __init__(self, limit=constants.outbound_queue_size):
+        self.limit = limit
+        # Entries are [collapse key, message] lists, so that collapsing can
+        # replace a message without moving it.
+        self.entries = collections.deque()
+        self.keyed = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, message):
+        m_type = message[:3]
+        key = None
+        if m_type in constants.COLLAPSIBLE_MESSAGES:
+            key = m_type, message[3:].split(":", 1)[0]
+            entry = self.keyed.get(key)
+            if entry is not None:
+                if m_type == "epu":
+                    entry[1] = merge_updates(entry[1], message)
+                else:
+                    entry[1] = message
+                metrics.incr("outbound.collapsed")
+                return
+        elif m_type in LIFECYCLE_MESSAGES:
+            entity_id = re.split("[:\n]", message[3:], 1)[0]
+            for update_type in constants.COLLAPSIBLE_MESSAGES:
+                self.keyed.pop((update_type, entity_id), None)
+
+        if len(self.entries) >= self.limit and not self._drop_oldest():
+            if m_type not in constants.RELIABLE_MESSAGES:
+                metrics.incr("outbound.dropped")
+                return
+
+        entry = [key, message]
+        self.entries.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+
+    def _drop_oldest(self):
+        """Drop the oldest unreliable message, returning whether one was."""
+        for entry in self.entries:
+            if entry[1][:3] not in constants.RELIABLE_MESSAGES:
+                self.entries.remove(entry)
+                if self.keyed.get(entry[0]) is entry:
+                    del self.keyed[entry[0]]
+                metrics.incr("outbound.dropped")
+                return True
+        return False
+
+    def pop_all(self):
+        """Return the queued messages, oldest first, and empty the queue."""
+        messages = [message for key, message in self.entries]
+        self.entries.clear()
+        self.keyed.clear()
+        return messages
@@ -0,0 +1,37 @@
+import redis
+
+import internals.constants as constants
+from internals.sharding import HashRing
+
+
+_ring = HashRing(constants.redis_locations)
+_connections = {}
+
+
+def get_endpoint(location):
+    """
+    Return the "host:port" of the Redis instance that holds a location's
+    channels and keys.
+    """
+    return _ring.get_node(str(location))
+
+
+def connect(endpoint):
+    """Open a new connection to a Redis instance."""
+    host, port = endpoint.split(":")
+    return redis.Redis(host=host, port=int(port))
+
+
+def get_redis(location=None):
+    """
+    Return a shared connection to the Redis instance for a location. If no
+    location is given, the connection is to the instance that holds the global
+    channels and keys.
+    """
+    if location is None:
+        endpoint = constants.redis
+    else:
+        endpoint = get_endpoint(location)
+    if endpoint not in _connections:
+        _connections[endpoint] = connect(endpoint)
+    return _connections[endpoint]
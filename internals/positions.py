@@ -0,0 +1,55 @@
+from internals.partitions import get_endpoint, get_redis
+
+
+class PositionStore(object):
+    """
+    Holds the positions of the players on this web worker and writes them to
+    their locations' Redis instances in batches. A position is written at
+    most once per flush, and only if it changed since it was last written, so
+    readers of l:p:<id> may see a position up to one flush old.
+    """
+
+    def __init__(self):
+        # Player IDs mapped to the location and position waiting to be
+        # written, and to the position that was last written.
+        self.pending = {}
+        self.written = {}
+
+    def update(self, location, player_id, x, y):
+        # Players between levels (e.g., while one is loading) have no
+        # position to write.
+        if location is None:
+            return
+        value = "%s:%d:%d" % (player_id, x, y)
+        if self.written.get(player_id) == value:
+            self.pending.pop(player_id, None)
+            return
+        self.pending[player_id] = str(location), value
+
+    def wrote(self, player_id, value):
+        """Record a position that was written to Redis directly."""
+        self.pending.pop(player_id, None)
+        self.written[player_id] = value
+
+    def discard(self, player_id):
+        """Forget a player, e.g., when their position key is deleted."""
+        self.pending.pop(player_id, None)
+        self.written.pop(player_id, None)
+
+    def flush(self):
+        """Write the pending positions with one pipeline per Redis instance."""
+        if not self.pending:
+            return
+
+        pipes = {}
+        for player_id, (location, value) in self.pending.items():
+            endpoint = get_endpoint(location)
+            if endpoint not in pipes:
+                pipes[endpoint] = get_redis(location).pipeline(
+                        transaction=False)
+            pipes[endpoint].set("l:p:%s" % player_id, value)
+            self.written[player_id] = value
+        self.pending = {}
+
+        for pipe in pipes.values():
+            pipe.execute()
@@ -0,0 +1,48 @@
+import internals.constants as constants
+
+
+def portal_destination(location, portal):
+    """Return the location code that a portal leads to."""
+    destination = portal["destination"]
+    if destination.startswith(":"):
+        return str(location) + destination
+    elif destination == "..":
+        return location.get_parent_code()
+    return destination
+
+
+def targets(location):
+    """
+    Return the levels that a player in `location` can slide or step into, as
+    (code, area) pairs. A level is worth prefetching while the player is in
+    its area, given as (left, top, right, bottom) in tiles.
+    """
+    distance = constants.prefetch_distance
+    width, height = location.width(), location.height()
+
+    found = []
+    if location.can_slide():
+        x, y = location.get_coords()
+        for dx, dy, area in ((-1, 0, (-distance, -distance,
+                                      distance, height + distance)),
+                             (1, 0, (width - distance, -distance,
+                                     width + distance, height + distance)),
+                             (0, -1, (-distance, -distance,
+                                      width + distance, distance)),
+                             (0, 1, (-distance, height - distance,
+                                     width + distance, height + distance))):
+            found.append((location.get_slide_code(x + dx, y + dy), area))
+
+    for portal in location.generate()[2]:
+        px, py = portal["x"], portal["y"]
+        pw, ph = portal["width"], portal["height"]
+        found.append((portal_destination(location, portal),
+                      (px - distance, py - distance,
+                       px + pw + distance, py + ph + distance)))
+    return found
+
+
+def due(targets, x, y):
+    """Return the codes of the targets whose areas contain (x, y)."""
+    return [code for code, (left, top, right, bottom) in targets if
+            left <= x < right and top <= y < bottom]
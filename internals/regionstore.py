@@ -0,0 +1,291 @@
+"""
+Pregenerated world regions, stored on disk in one memory-mapped file per
+world. Every process that reads a world maps the same file, so they share its
+pages instead of each generating the regions or loading them into memory up
+front.
+
+A file starts with a header, followed by one fixed-size record for every
+region within constants.region_store_radius of the origin, row by row. A
+record is a flag that is set once the record has been written, the length of
+the packed portals, the tiles as big-endian uint16s, the hitmap as bytes, and
+the marshalled portals.
+
+Dungeon rooms and building interiors come in all sizes, so they're kept in a
+second file per world. It starts with a header and is followed by records
+that are added one after the other. A record is the length of its location
+code, the width, height and length of the packed portals, the code, and the
+terrain encoded the same way as a region's.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+import constants
+import terraincache
+
+
+MAGIC = "LOAREGN1"
+# The magic string, the level version, the region width and height, the
+# radius, and the space set aside for portals.
+HEADER = struct.Struct("!8sIHHHH")
+HEADER_SIZE = 64
+# The present flag and the length of the portals.
+RECORD_HEADER = struct.Struct("!BH")
+
+SUBLOCATION_MAGIC = "LOASUBL1"
+# The magic string and the level version.
+SUBLOCATION_HEADER = struct.Struct("!8sI")
+# The length of the code, the width, the height and the length of the
+# portals.
+SUBLOCATION_RECORD = struct.Struct("!HHHI")
+
+# (world, extension) pairs mapped to their open stores.
+_stores = {}
+# Stores that don't exist, mapped to when that was last checked. They're
+# checked again now and then, so a store that is pregenerated while a server
+# is running is picked up.
+_missing = {}
+MISSING_RECHECK = 60
+
+
+class RegionStore(object):
+
+    def __init__(self, path, writable=False,
+                 radius=constants.region_store_radius,
+                 width=constants.level_width, height=constants.level_height,
+                 portal_size=constants.region_portal_size):
+        """
+        Open a region store. A writable store is created if it doesn't exist.
+        Raises ValueError if the file was made with other settings.
+        """
+        self.radius = radius
+        self.width, self.height = width, height
+        self.portal_size = portal_size
+        self.tiles_size = width * height * 2
+        self.record_size = (RECORD_HEADER.size + self.tiles_size +
+                            width * height + portal_size)
+
+        header = HEADER.pack(MAGIC, constants.level_version, width, height,
+                             radius, portal_size)
+        if writable and not os.path.exists(path):
+            with open(path, "wb") as store_file:
+                store_file.write(header.ljust(HEADER_SIZE, "\0"))
+                # The records are left as a hole until they're written.
+                store_file.truncate(HEADER_SIZE +
+                                    (2 * radius) ** 2 * self.record_size)
+
+        with open(path, "r+b" if writable else "rb") as store_file:
+            self.map = mmap.mmap(store_file.fileno(), 0,
+                                 access=mmap.ACCESS_WRITE if writable else
+                                        mmap.ACCESS_READ)
+        if self.map[:HEADER.size] != header:
+            self.map.close()
+            raise ValueError("%s was made with other settings" % path)
+
+    def _offset(self, x, y):
+        """Return where a region's record starts, or None if it has none."""
+        if not (-self.radius <= x < self.radius and
+                -self.radius <= y < self.radius):
+            return None
+        index = (y + self.radius) * 2 * self.radius + x + self.radius
+        return HEADER_SIZE + index * self.record_size
+
+    def has(self, x, y):
+        offset = self._offset(x, y)
+        return offset is not None and self.map[offset] != "\0"
+
+    def load(self, x, y):
+        """Return a region's (terrain, hitmap, portals), or None."""
+        offset = self._offset(x, y)
+        if offset is None:
+            return None
+        present, portals_length = RECORD_HEADER.unpack_from(self.map, offset)
+        if not present:
+            return None
+
+        return terraincache.decode(self.map, self.width, self.height,
+                                   portals_length,
+                                   offset + RECORD_HEADER.size)
+
+    def save(self, x, y, terrain, hitmap, portals):
+        """
+        Store a region. Returns False if it's outside of the store or doesn't
+        fit in a record.
+        """
+        offset = self._offset(x, y)
+        if offset is None:
+            return False
+        encoded = terraincache.encode(terrain, hitmap, portals)
+        if encoded is None:
+            return False
+        width, height, record, portals_length = encoded
+        if ((width, height) != (self.width, self.height) or
+            portals_length > self.portal_size):
+            return False
+
+        start = offset + RECORD_HEADER.size
+        self.map[start:start + len(record)] = record
+        # The record is only marked as present once the rest is in place.
+        self.map[offset:start] = RECORD_HEADER.pack(1, portals_length)
+        return True
+
+    def close(self):
+        self.map.close()
+
+
+class SublocationStore(object):
+
+    def __init__(self, path, writable=False):
+        """
+        Open a sublocation store. A writable store is created if it doesn't
+        exist, and a record that was cut off by an interrupted write is
+        dropped. Raises ValueError if the file was made for another level
+        version.
+        """
+        header = SUBLOCATION_HEADER.pack(SUBLOCATION_MAGIC,
+                                         constants.level_version)
+        if writable and not os.path.exists(path):
+            with open(path, "wb") as store_file:
+                store_file.write(header)
+
+        self.file = open(path, "r+b" if writable else "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:SUBLOCATION_HEADER.size] != header:
+            self.close()
+            raise ValueError("%s was made with other settings" % path)
+
+        # Codes mapped to where their records start.
+        self.records = {}
+        offset, size = SUBLOCATION_HEADER.size, len(self.map)
+        while offset + SUBLOCATION_RECORD.size <= size:
+            code_length, width, height, portals_length = (
+                    SUBLOCATION_RECORD.unpack_from(self.map, offset))
+            start = offset + SUBLOCATION_RECORD.size
+            end = start + code_length + width * height * 3 + portals_length
+            if end > size:
+                break
+            self.records[self.map[start:start + code_length]] = offset
+            offset = end
+        self.end = offset
+        if not writable:
+            self.file.close()
+        elif self.end < size:
+            self.map.close()
+            self.file.truncate(self.end)
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+    def has(self, code):
+        return code in self.records
+
+    def load(self, code):
+        """
+        Return a sublocation's (terrain, hitmap, portals), or None. Records
+        that were saved since the store was opened aren't loaded.
+        """
+        offset = self.records.get(code)
+        if offset is None or offset >= len(self.map):
+            # It was saved after the file was mapped.
+            return None
+        code_length, width, height, portals_length = (
+                SUBLOCATION_RECORD.unpack_from(self.map, offset))
+        return terraincache.decode(self.map, width, height, portals_length,
+                                   offset + SUBLOCATION_RECORD.size +
+                                   code_length)
+
+    def save(self, code, terrain, hitmap, portals):
+        """
+        Store a sublocation at the end of the file. Returns False if it can't
+        be encoded.
+        """
+        encoded = terraincache.encode(terrain, hitmap, portals)
+        if encoded is None:
+            return False
+        width, height, record, portals_length = encoded
+        self.file.seek(self.end)
+        self.file.write(SUBLOCATION_RECORD.pack(len(code), width, height,
+                                                portals_length))
+        self.file.write(code)
+        self.file.write(record)
+        self.file.flush()
+        self.records[code] = self.end
+        self.end = self.file.tell()
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def _get(store_type, world, extension):
+    key = world, extension
+    if key in _stores:
+        return _stores[key]
+    now = time.time()
+    if now - _missing.get(key, 0) < MISSING_RECHECK:
+        return None
+
+    path = os.path.join(constants.region_store_path,
+                        "%s.%s" % (world, extension))
+    if not os.path.exists(path):
+        _missing[key] = now
+        return None
+    try:
+        store = store_type(path)
+    except ValueError:
+        store = None
+    _stores[key] = store
+    return store
+
+
+def get_store(world):
+    """
+    Return the RegionStore for a world, or None if the world hasn't been
+    pregenerated.
+    """
+    return _get(RegionStore, world, "regions")
+
+
+def get_sublocation_store(world):
+    """
+    Return the SublocationStore for a world, or None if the world's
+    sublocations haven't been pregenerated.
+    """
+    return _get(SublocationStore, world, "sublocations")
+
+
+def load(world, x, y):
+    """Return a pregenerated region's (terrain, hitmap, portals), or None."""
+    store = get_store(world)
+    if store is None:
+        return None
+    return store.load(x, y)
+
+
+def open_stores():
+    """
+    Open every store in constants.region_store_path. Processes that are
+    forked afterwards share the mappings and don't have to read the
+    sublocation stores' records again.
+    """
+    if not os.path.isdir(constants.region_store_path):
+        return
+    for name in sorted(os.listdir(constants.region_store_path)):
+        world, extension = os.path.splitext(name)
+        if extension == ".regions":
+            get_store(world)
+        elif extension == ".sublocations":
+            get_sublocation_store(world)
+
+
+def load_sublocation(world, code):
+    """
+    Return a pregenerated sublocation's (terrain, hitmap, portals), or None.
+    `code` is the sublocation's code without an instance.
+    """
+    store = get_sublocation_store(world)
+    if store is None:
+        return None
+    return store.load(code)
@@ -0,0 +1,91 @@
+import internals.constants as constants
+from internals.sharding import NODE_CHANNEL
+
+
+# The entity node running each location. Owners refresh these keys on every
+# heartbeat, so a location whose node disappears becomes unowned once the key
+# expires.
+LOCATION_OWNER = "l:o:%s"
+# Set while a location is being handed from one node to another.
+LOCATION_MIGRATING = "l:m:%s"
+
+
+class LocationRegistry(object):
+    """
+    Maps locations to the entity nodes that run them. Locations that aren't
+    running anywhere are assigned with the membership's hash ring.
+    """
+
+    def __init__(self, redis, membership):
+        self.redis = redis
+        self.membership = membership
+
+    def owner(self, location):
+        """Return the node that is (or should be) running `location`."""
+        owner = self.redis.get(LOCATION_OWNER % location)
+        if owner:
+            return owner
+        return self.membership.ring().get_node(str(location))
+
+    def claim(self, location, node):
+        """
+        Register `node` as the owner of `location` unless another node has
+        already done so. Returns the node that owns the location.
+        """
+        key = LOCATION_OWNER % location
+        pipe = self.redis.pipeline()
+        pipe.setnx(key, node)
+        pipe.get(key)
+        claimed, owner = pipe.execute()
+        if claimed:
+            self.redis.expire(key, constants.node_timeout)
+        return owner
+
+    def assign(self, location, node):
+        """Unconditionally make `node` the owner of `location`."""
+        key = LOCATION_OWNER % location
+        pipe = self.redis.pipeline()
+        pipe.set(key, node)
+        pipe.expire(key, constants.node_timeout)
+        pipe.execute()
+
+    def refresh(self, locations):
+        """Extend the registrations of the locations that a node runs."""
+        if not locations:
+            return
+        pipe = self.redis.pipeline()
+        for location in locations:
+            pipe.expire(LOCATION_OWNER % location, constants.node_timeout)
+        pipe.execute()
+
+    def release(self, location, node):
+        """Remove a registration, provided that `node` still holds it."""
+        key = LOCATION_OWNER % location
+        if self.redis.get(key) == node:
+            self.redis.delete(key)
+
+    def start_migration(self, location, node):
+        """Mark `location` as on its way to `node`."""
+        key = LOCATION_MIGRATING % location
+        pipe = self.redis.pipeline()
+        pipe.set(key, node)
+        pipe.expire(key, constants.migration_timeout)
+        pipe.execute()
+        self.assign(location, node)
+
+    def end_migration(self, location):
+        self.redis.delete(LOCATION_MIGRATING % location)
+
+    def is_migrating(self, location):
+        return self.redis.exists(LOCATION_MIGRATING % location)
+
+    def publish(self, location, data):
+        """
+        Send a message about `location` to the node that owns it. Returns
+        False if there are no entity nodes to send it to.
+        """
+        owner = self.owner(location)
+        if owner is None:
+            return False
+        self.redis.publish(NODE_CHANNEL % owner, "%s>%s" % (location, data))
+        return True
@@ -0,0 +1,122 @@
+import bisect
+import hashlib
+import time
+
+import internals.constants as constants
+
+
+NODE_SET = "entity:nodes"
+NODE_HEARTBEAT = "entity:node:%s"
+# Messages directed at a single entity node.
+NODE_CHANNEL = "entity::%s"
+
+# A hash of location codes to the node running them and the share of a CPU
+# core that the location's servlet is using.
+SERVLET_LOAD = "servlet:load"
+
+
+def _hash(value):
+    """Hash a string onto the ring as an integer."""
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring that maps location codes onto entity nodes. Each
+    node is placed on the ring many times (virtual nodes) so that the keyspace
+    is spread evenly, and adding or removing a node only moves the locations
+    that fall between that node's points and their predecessors.
+    """
+
+    def __init__(self, nodes=(), replicas=constants.virtual_nodes):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = _hash("%s#%d" % (node, replica))
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for replica in range(self.replicas):
+            point = _hash("%s#%d" % (node, replica))
+            del self._owners[point]
+            self._points.remove(point)
+
+    def get_node(self, key):
+        """Return the node that owns `key`, or None if the ring is empty."""
+        if not self._points:
+            return None
+
+        index = bisect.bisect(self._points, _hash(str(key)))
+        if index == len(self._points):
+            index = 0
+        return self._owners[self._points[index]]
+
+
+class NodeMembership(object):
+    """
+    Keeps track of which entity nodes are alive. Every node adds itself to a
+    Redis set and refreshes a heartbeat key that expires if the node goes
+    away; nodes without a heartbeat are not placed on the ring.
+
+    Web workers are tracked the same way, under their own set and heartbeat
+    keys.
+    """
+
+    def __init__(self, redis, node_id, node_set=NODE_SET,
+                 node_heartbeat=NODE_HEARTBEAT):
+        self.redis = redis
+        self.node_id = node_id
+        self.node_set = node_set
+        self.node_heartbeat = node_heartbeat
+
+        self._ring = None
+        self._ring_updated = 0
+
+    def join(self):
+        self.redis.sadd(self.node_set, self.node_id)
+        self.heartbeat()
+
+    def heartbeat(self):
+        key = self.node_heartbeat % self.node_id
+        pipe = self.redis.pipeline()
+        pipe.set(key, "1")
+        pipe.expire(key, constants.node_timeout)
+        pipe.execute()
+
+    def leave(self):
+        self.redis.srem(self.node_set, self.node_id)
+        self.redis.delete(self.node_heartbeat % self.node_id)
+
+    def live_nodes(self):
+        """Return the nodes with a current heartbeat."""
+        nodes = sorted(self.redis.smembers(self.node_set))
+        pipe = self.redis.pipeline()
+        for node in nodes:
+            pipe.exists(self.node_heartbeat % node)
+        return [node for node, alive in zip(nodes, pipe.execute()) if alive]
+
+    def ring(self):
+        """
+        Return the hash ring of live nodes. The ring is rebuilt at most once
+        per heartbeat period.
+        """
+        now = time.time()
+        if (self._ring is None or
+            now - self._ring_updated > constants.node_heartbeat):
+            self._ring = HashRing(self.live_nodes())
+            self._ring_updated = now
+        return self._ring
@@ -0,0 +1,153 @@
+"""
+A cache of generated terrain that every process in the cluster shares, below
+each Location's own cache. Terrain is kept in memcached if the memcache
+module is installed and constants.memcached is set. Otherwise, it's kept in a
+LocalCache, which only lasts as long as the process.
+"""
+
+import array
+import collections
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+import constants
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+
+# Stored in packed terrain so that the format can change later.
+ENCODING = 1
+# The encoding, width, height and length of the packed portals.
+HEADER = struct.Struct("!BHHI")
+
+
+class LocalCache(object):
+    """
+    A stand-in for memcache.Client that keeps the most recently used values
+    in a dict.
+    """
+
+    def __init__(self, limit=constants.level_cache_size):
+        self.limit = limit
+        self.values = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.values[key] = value
+        return value
+
+    def set(self, key, value):
+        self.values.pop(key, None)
+        self.values[key] = value
+        if len(self.values) > self.limit:
+            self.values.popitem(last=False)
+        return True
+
+
+_client = None
+# The process that _client was made in. Forked processes make their own, so
+# that they don't share its sockets.
+_client_pid = None
+
+
+def is_shared():
+    """Return whether terrain is shared with other processes."""
+    return not isinstance(get_client(), LocalCache)
+
+
+def get_client():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        if memcache and constants.memcached:
+            _client = memcache.Client([constants.memcached])
+        else:
+            _client = LocalCache()
+        _client_pid = os.getpid()
+    return _client
+
+
+def encode(terrain, hitmap, portals):
+    """
+    Encode terrain as its tiles (big-endian uint16s), its hitmap (bytes) and
+    its marshalled portals, one after the other. Returns the width, the
+    height, the encoded terrain and the length of the portals, or None if the
+    terrain can't be encoded.
+    """
+    height = len(terrain)
+    width = len(terrain[0]) if height else 0
+    try:
+        tiles = array.array("H", (tile for row in terrain for tile in row))
+        hits = array.array("B", (cell for row in hitmap for cell in row))
+    except (OverflowError, TypeError):
+        return None
+    if len(tiles) != width * height or len(hits) != width * height:
+        return None
+
+    if sys.byteorder == "little":
+        tiles.byteswap()
+    portals = marshal.dumps(portals)
+    return (width, height, tiles.tostring() + hits.tostring() + portals,
+            len(portals))
+
+
+def decode(data, width, height, portals_length, offset=0):
+    """Reverse encode(), reading from `offset` in `data`."""
+    tiles = array.array("H", data[offset:offset + width * height * 2])
+    if sys.byteorder == "little":
+        tiles.byteswap()
+    offset += width * height * 2
+    hits = array.array("B", data[offset:offset + width * height])
+    offset += width * height
+    portals = marshal.loads(data[offset:offset + portals_length])
+
+    terrain = [tiles[y * width:(y + 1) * width].tolist() for
+               y in range(height)]
+    hitmap = [hits[y * width:(y + 1) * width].tolist() for y in range(height)]
+    return terrain, hitmap, portals
+
+
+def pack(terrain, hitmap, portals):
+    """
+    Pack generated terrain into a string. Returns None if the terrain can't
+    be packed.
+    """
+    encoded = encode(terrain, hitmap, portals)
+    if encoded is None:
+        return None
+    width, height, data, portals_length = encoded
+    return zlib.compress(HEADER.pack(ENCODING, width, height, portals_length) +
+                         data)
+
+
+def unpack(data):
+    """Reverse pack(). Returns None if `data` is in another encoding."""
+    data = zlib.decompress(data)
+    encoding, width, height, portals_length = HEADER.unpack_from(data)
+    if encoding != ENCODING:
+        return None
+    return decode(data, width, height, portals_length, HEADER.size)
+
+
+def _key(code):
+    return "t:%d:%s" % (constants.level_version, code)
+
+
+def load(code):
+    """Return the (terrain, hitmap, portals) stored for a code, or None."""
+    data = get_client().get(_key(code))
+    if data is None:
+        return None
+    return unpack(data)
+
+
+def save(code, terrain, hitmap, portals):
+    data = pack(terrain, hitmap, portals)
+    if data is not None:
+        get_client().set(_key(code), data)
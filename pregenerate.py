@@ -0,0 +1,199 @@
+"""
+Pregenerate the regions of a world so that players don't wait for them to be
+generated. Regions (including their towns and dungeon portals) are written to
+the world's region store. With --sublocations, dungeon rooms and building
+interiors are generated too and written to the world's sublocation store.
+
+Runs can be stopped and started again; regions and sublocations that are
+already stored are skipped.
+
+    python pregenerate.py -16 -16 16 16
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import internals.constants as constants
+import internals.levelbuilder.dungeons as dungeons
+from internals.locations import Location
+from internals.regionstore import RegionStore, SublocationStore
+
+
+def sublocation_codes(location):
+    """
+    Return the codes of the dungeon rooms and building interiors that can be
+    reached from a region.
+    """
+    code = str(location)
+    if location.is_town():
+        return sorted(set(code + portal["destination"] for portal in
+                          location.generate()[2] if
+                          portal["destination"].startswith(":b:")))
+    if not location.is_dungeon():
+        return []
+
+    lobby = Location(code + ":d:0:0")
+    rooms = dungeons._build_dungeon_layout(lobby)
+    offset_x, offset_y = dungeons.get_offset(lobby)
+    return ["%s:d:%d:%d" % (code, x - offset_x, y - offset_y) for
+            y, row in enumerate(rooms) for x, room in enumerate(row) if
+            room["defined"]]
+
+
+# The codes of the sublocations that were stored before the run started. Each
+# of the pool's processes reads them once.
+_stored_sublocations = frozenset()
+
+
+def _load_stored_sublocations(path):
+    global _stored_sublocations
+    if path and os.path.exists(path):
+        store = SublocationStore(path)
+        _stored_sublocations = frozenset(store.records)
+        store.close()
+
+
+def pregenerate_region(job):
+    """
+    Generate a region, and its sublocations if `sublocations` is set. This is
+    run in the pool's processes. The region is returned to be written to the
+    store, unless `region` is False because it's there already, along with
+    the (code, generated) pairs of the sublocations that aren't stored yet and
+    the (what, traceback) pairs of anything that couldn't be generated.
+    """
+    world, x, y, region, sublocations = job
+    location = Location("%s:%d:%d" % (world, x, y))
+    try:
+        # This also finds the portals of a region that's already stored.
+        generated = location.generate()
+    except Exception:
+        return x, y, None, [], [(str(location), traceback.format_exc())]
+
+    generated_sublocations, errors = [], []
+    if sublocations:
+        try:
+            codes = sublocation_codes(location)
+        except Exception:
+            codes = []
+            errors.append(("the sublocations of %s" % location,
+                           traceback.format_exc()))
+        for code in codes:
+            if code in _stored_sublocations:
+                continue
+            try:
+                generated_sublocations.append((code, Location(code).generate()))
+            except Exception:
+                errors.append((code, traceback.format_exc()))
+    return (x, y, generated if region else None, generated_sublocations,
+            errors)
+
+
+def region_order(left, top, right, bottom):
+    """
+    Return the regions in a rectangle, closest to the origin first, so that a
+    partial run covers where players start.
+    """
+    regions = [(x, y) for y in range(top, bottom) for x in range(left, right)]
+    regions.sort(key=lambda (x, y): (max(abs(x), abs(y)), y, x))
+    return regions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Pregenerate the regions of a world.")
+    parser.add_argument("left", type=int)
+    parser.add_argument("top", type=int)
+    parser.add_argument("right", type=int, help="exclusive")
+    parser.add_argument("bottom", type=int, help="exclusive")
+    parser.add_argument("--world", default="o")
+    parser.add_argument("--store", default=constants.region_store_path,
+                        help="the directory to write the stores to")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--sublocations", action="store_true",
+                        help="also generate dungeon rooms and building "
+                             "interiors")
+    args = parser.parse_args(argv)
+
+    radius = constants.region_store_radius
+    if not (-radius <= args.left < args.right <= radius and
+            -radius <= args.top < args.bottom <= radius):
+        parser.error("the rectangle must be within %d regions of the origin" %
+                     radius)
+
+    if not os.path.exists(args.store):
+        os.makedirs(args.store)
+    store = RegionStore(os.path.join(args.store, "%s.regions" % args.world),
+                        writable=True)
+    sublocation_store, sublocation_path = None, None
+    if args.sublocations:
+        sublocation_path = os.path.join(args.store,
+                                        "%s.sublocations" % args.world)
+        sublocation_store = SublocationStore(sublocation_path, writable=True)
+
+    regions = region_order(args.left, args.top, args.right, args.bottom)
+    jobs, stored = [], 0
+    for x, y in regions:
+        region = not store.has(x, y)
+        stored += not region
+        if region or args.sublocations:
+            jobs.append((args.world, x, y, region, args.sublocations))
+    skipped = len(regions) - len(jobs)
+    print "%d regions, %d already in the store" % (len(regions), stored)
+
+    pool = multiprocessing.Pool(args.processes, _load_stored_sublocations,
+                                (sublocation_path, ))
+    start = last_report = time.time()
+    processed, done, failed, sublocations = 0, 0, 0, 0
+    try:
+        for x, y, generated, generated_sublocations, errors in (
+                pool.imap_unordered(pregenerate_region, jobs, chunksize=4)):
+            processed += 1
+            for what, error in errors:
+                failed += 1
+                print >> sys.stderr, "\nCould not generate %s:\n%s" % (
+                        what, error)
+            if generated is not None:
+                if store.save(x, y, *generated):
+                    done += 1
+                else:
+                    failed += 1
+                    print >> sys.stderr, (
+                            "\n%d:%d doesn't fit in a record" % (x, y))
+            for code, level in generated_sublocations:
+                if sublocation_store.save(code, *level):
+                    sublocations += 1
+                else:
+                    failed += 1
+                    print >> sys.stderr, "\n%s can't be stored" % code
+
+            now = time.time()
+            if now - last_report >= 1:
+                last_report = now
+                rate = processed / (now - start)
+                remaining = len(jobs) - processed
+                sys.stdout.write(
+                        "\r%d/%d regions, %d failed, %.1f regions/s, "
+                        "%ds left " % (processed, len(jobs), failed, rate,
+                                       remaining / rate if rate else 0))
+                sys.stdout.flush()
+    finally:
+        pool.terminate()
+        store.close()
+        if sublocation_store:
+            sublocation_store.close()
+
+    elapsed = time.time() - start
+    rate = processed / elapsed if elapsed else 0
+    print ("\nGenerated %d regions and %d sublocations in %.1fs "
+           "(%.1f regions/s); %d failed, %d skipped" %
+           (done, sublocations, elapsed, rate, failed, skipped))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
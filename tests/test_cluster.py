@@ -0,0 +1,116 @@
+from nose.tools import eq_
+
+import internals.cluster as cluster
+import internals.constants as constants
+from internals.cluster import rank_workers
+
+
+def test_rank_workers():
+    """Test that players are only moved to workers hosting more players."""
+    counts = {"a:1": "3", "b:2": "5", "c:3": "1", "d:4": "5"}
+    eq_(rank_workers(counts, "a:1"), ["b:2", "d:4"])
+    eq_(rank_workers(counts, "b:2"), [])
+    eq_(rank_workers(counts, "e:5"), ["b:2", "d:4", "a:1", "c:3"])
+    eq_(rank_workers({}, "a:1"), [])
+
+
+class FakeRedis(object):
+    """Just enough of a Redis client for the handoff functions."""
+
+    def __init__(self):
+        self.values = {}
+        self.scores = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def zrangebyscore(self, key, low, high):
+        return sorted(member for member, score in self.scores.items() if
+                      score <= high)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+        # Commands run straight away between watch() and multi().
+        self.watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def watch(self, key):
+        self.watching = True
+
+    def multi(self):
+        self.watching = False
+
+    def get(self, key):
+        if self.watching:
+            return self.redis.values.get(key)
+        self.commands.append(lambda: self.redis.values.get(key))
+
+    def set(self, key, value):
+        self.commands.append(lambda: self.redis.values.__setitem__(key, value))
+
+    def expire(self, key, seconds):
+        self.commands.append(lambda: True)
+
+    def delete(self, key):
+        self.commands.append(
+                lambda: int(self.redis.values.pop(key, None) is not None))
+
+    def zadd(self, key, mapping):
+        self.commands.append(lambda: self.redis.scores.update(mapping))
+
+    def zrem(self, key, member):
+        self.commands.append(
+                lambda: int(self.redis.scores.pop(member, None) is not None))
+
+    def execute(self):
+        results = [command() for command in self.commands]
+        self.commands = []
+        return results
+
+
+def test_handoff_token():
+    """Test that a handed off session can't be resumed with the ID alone."""
+    global_redis = cluster.global_redis
+    cluster.global_redis = FakeRedis()
+    try:
+        token = cluster.save_handoff("p1", {"location": "o:0:0"})
+        eq_(cluster.load_handoff("p1", ""), None)
+        eq_(cluster.load_handoff("p1", "0" * len(token)), None)
+        eq_(cluster.load_handoff("p2", token), None)
+
+        eq_(cluster.load_handoff("p1", token), {"location": "o:0:0"})
+        # Tokens can only be used once.
+        eq_(cluster.load_handoff("p1", token), None)
+        assert cluster.save_handoff("p1", {}) != token
+    finally:
+        cluster.global_redis = global_redis
+
+
+def test_expired_handoffs():
+    """Test that players who don't resume in time are given up on once."""
+    global_redis = cluster.global_redis
+    cluster.global_redis = fake = FakeRedis()
+    try:
+        cluster.save_handoff("p1", {"location": "o:0:0"})
+        token = cluster.save_handoff("p2", {"location": "o:1:0"})
+        cluster.save_handoff("p3", {"location": "o:2:0"})
+        cluster.load_handoff("p2", token)
+        eq_(cluster.expired_handoffs(), [])
+
+        fake.scores["p1"] -= constants.handoff_timeout
+        fake.scores["p3"] -= constants.handoff_timeout
+        eq_(cluster.expired_handoffs(), [("p1", {"location": "o:0:0"}),
+                                         ("p3", {"location": "o:2:0"})])
+        eq_(cluster.expired_handoffs(), [])
+        eq_(fake.values, {})
+    finally:
+        cluster.global_redis = global_redis
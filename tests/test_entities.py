@@ -0,0 +1,77 @@
+import random
+import time
+
+from nose.tools import eq_
+
+from internals.entities.child import Child
+from internals.entities.homely import Homely
+from internals.entities.soldier import Soldier
+from internals.locations import Location
+
+
+class FakeServlet(object):
+
+    def __init__(self):
+        self.location = Location("o:0:0")
+        self.entities = []
+        self.notified = []
+
+    def notify_location(self, command, message, **kwargs):
+        self.notified.append(command + message)
+
+
+def test_restore():
+    """Test that restored entities keep their appearance and timers."""
+    servlet = FakeServlet()
+    child = Child(servlet)
+    child.place(20, 30)
+    child.deschedule_all()
+    child.timers = []
+    child.schedule(30, child.stop_wandering)
+    child.image = "child2"
+    child.speed = 1.1
+
+    copies = [Child.restore(servlet, child.get_state()) for i in range(5)]
+    try:
+        for copy in copies:
+            eq_(copy.id, child.id)
+            eq_(copy.image, "child2")
+            eq_(copy.speed, 1.1)
+            eq_([timer[3] for timer in copy.timers], [copy.stop_wandering])
+            assert 29 < copy.timers[0][0] - time.time() <= 30
+    finally:
+        for entity in [child] + copies:
+            entity.destroy(notify=False)
+
+
+def test_rng():
+    """Test that entities choose how they look with the Random they're given."""
+    servlet = FakeServlet()
+    for entity_type in (Child, Homely, Soldier):
+        entities = []
+        for seed in (1, 2):
+            random.seed(seed)
+            entities.append(entity_type(servlet, rng=random.Random("o:0:0")))
+        try:
+            eq_(entities[0].image, entities[1].image)
+        finally:
+            for entity in entities:
+                entity.destroy(notify=False)
+
+
+def test_movement_time():
+    """Test that broadcast positions say when they were taken."""
+    servlet = FakeServlet()
+    child = Child(servlet)
+    child.place(20, 30)
+    try:
+        before = int(time.time() * 1000)
+        child.broadcast_changes("x", "y")
+        child.broadcast_changes("image")
+        moved, changed = [message.split("\n") for message in
+                          servlet.notified[-2:]]
+        eq_(moved[-1][:2], "t=")
+        assert before <= int(moved[-1][2:]) <= time.time() * 1000
+        assert not [line for line in changed if line.startswith("t=")]
+    finally:
+        child.destroy(notify=False)
@@ -0,0 +1,41 @@
+import collections
+
+from nose.tools import eq_
+
+import internals.generation as generation
+from internals.locations import Location
+
+
+def setup():
+    global waiting, generated
+    waiting, generated = generation._waiting, generation._generated
+    generation._waiting = {}
+    generation._generated = collections.OrderedDict()
+
+
+def teardown():
+    generation._waiting, generation._generated = waiting, generated
+
+
+def test_load_joins_waiting():
+    """Test that requests for a level being generated share the result."""
+    first, second = Location("o:2:3"), Location("o~1:2:3")
+    results = []
+    generation._waiting["o:2:3"] = [(first, results.append)]
+    generation.load(second, results.append)
+    eq_(len(generation._waiting["o:2:3"]), 2)
+
+    generation._finish("o:2:3", generation._generate("o:2:3"))
+    eq_(results, [True, True])
+    assert "o:2:3" not in generation._waiting
+    eq_(first._terrain_cache, Location("o:2:3").generate()[0])
+    assert second._terrain_cache is first._terrain_cache
+
+
+def test_load_inline():
+    """Test that levels are generated inline when there's no pool."""
+    results = []
+    location = Location("o:3:2")
+    generation.load(location, results.append)
+    eq_(results, [True])
+    assert location._terrain_cache is not None
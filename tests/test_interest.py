@@ -0,0 +1,77 @@
+from nose.tools import eq_
+
+from internals.constants import interest_cell_size, tilesize
+from internals.interest import (InterestArea, LastKnown, get_cell,
+                                split_header, tag)
+
+
+CELL = interest_cell_size * tilesize
+
+
+def test_header():
+    """Test that cell tags survive the trip through a message header."""
+    eq_(split_header(tag("o:0:0")), ("o:0:0", None))
+    eq_(split_header(tag("o:0:0:b:1:2:x", (CELL * 2 + 1, 5))),
+        ("o:0:0:b:1:2:x", (2, 0)))
+
+
+def test_can_see():
+    area = InterestArea((5, 5))
+    eq_(area.cell, (0, 0))
+    assert area.can_see(None)
+    assert area.can_see((1, 1))
+    assert not area.can_see((10, 0))
+
+
+def test_hysteresis():
+    """
+    Test that the area only follows a player once they're well past the edge
+    of their cell.
+    """
+    area = InterestArea((CELL - 1, 0))
+    eq_(area.cell, (0, 0))
+
+    area.update((CELL + 1, 0))
+    eq_(area.cell, (0, 0))
+
+    area.update((CELL * 1.5, 0))
+    eq_(area.cell, get_cell((CELL * 1.5, 0)))
+    eq_(area.cell, (1, 0))
+
+    # Stepping back over the edge doesn't move the area back.
+    area.update((CELL - 1, 0))
+    eq_(area.cell, (1, 0))
+
+
+def test_relay_header():
+    """Test that only relayed message types get a marked header."""
+    eq_(tag("o:0:0", message_type="epu"), "*o:0:0")
+    eq_(tag("o:0:0", (CELL, 0), "snd"), "*o:0:0#1:0")
+    eq_(tag("o:0:0", message_type="cha"), "o:0:0")
+
+
+def test_resync():
+    """
+    Test that a client whose area moves is told about an entity that stopped
+    while it was out of view.
+    """
+    area = InterestArea((0, 0))
+    seen = LastKnown()
+    cell = get_cell((CELL * 4, 0))
+    seen.record("epu@e:x_vel=1\ny_vel=0\nx=%d\ny=0" % (CELL * 4), cell)
+    seen.record("epu@e:x_vel=0\nx=%d" % (CELL * 4 + 20), cell)
+    seen.record("epu@f:x_vel=0", (0, 0))
+    assert not area.can_see(cell)
+
+    old_cell = area.cell
+    assert area.update((CELL * 2.5, 0))
+    eq_(seen.newly_visible(area.cell, old_cell),
+        ["epu@e:x_vel=0\ny_vel=0\nx=%d\ny=0" % (CELL * 4 + 20)])
+
+    # Nothing is sent again while it stays in view.
+    old_cell = area.cell
+    assert area.update((CELL * 3.5, 0))
+    eq_(seen.newly_visible(area.cell, old_cell), [])
+
+    seen.forget("@e")
+    eq_(seen.newly_visible(area.cell, None), [])
@@ -0,0 +1,35 @@
+import gzip
+import json
+import StringIO
+
+from nose.tools import eq_
+
+import internals.constants as constants
+from internals.levelcache import get_level, level_message
+from internals.levelcodec import decode_content
+from internals.locations import Location
+
+
+def test_get_level():
+    """Test that instances share content and that content is complete."""
+    level = get_level("o:0:0")
+    eq_(get_level("o~1:0:0"), level)
+    eq_(get_level(Location("o:0:0")), level)
+    assert get_level("o:0:1").hash != level.hash
+
+    content = decode_content(json.loads(level.content))
+    assert "avatar" not in content
+    eq_(len(content["level"]), content["h"])
+
+    gzipped = gzip.GzipFile(fileobj=StringIO.StringIO(level.gzipped))
+    eq_(gzipped.read(), level.content)
+
+
+def test_level_message():
+    """Test that the player's fields are spliced into valid JSON."""
+    message = level_message(Location("o~1:0:0"), 5, 6.3, 90)
+    eq_(message[:3], "lev")
+    eq_(json.loads(message[3:]),
+        {"code": "o:0:0", "version": constants.level_version,
+         "hash": get_level("o:0:0").hash, "avatar": {"x": 5, "y": 6.3},
+         "health": 90})
@@ -0,0 +1,32 @@
+from nose.tools import eq_
+
+from internals.levelcodec import (decode_bits, decode_content, decode_grid,
+                                  encode_bits, encode_content, encode_grid)
+from internals.locations import Location
+
+
+def test_grid():
+    grid = [[1, 1, 1], [1, 2, 2], [0, 0, 161]]
+    eq_(decode_grid(encode_grid(grid), 3, 3), grid)
+
+    # Runs longer than a byte can count are split.
+    grid = [[5] * 300]
+    eq_(decode_grid(encode_grid(grid), 300, 1), grid)
+
+
+def test_bits():
+    grid = [[0, 1, 1], [1, 0, 0], [0, 0, 1]]
+    eq_(decode_bits(encode_bits(grid), 3, 3), grid)
+
+
+def test_content():
+    """Test that real levels survive a round trip."""
+    for code in ("o:0:0", "o:2:3", "o:0:0:b:1:2:house", "o:1:0:d:0:0"):
+        content = Location(code).content()
+        encoded = encode_content(content)
+        eq_(encoded["encoding"], 1)
+        eq_(decode_content(encoded), content)
+
+    # Content that doesn't fit the format is left alone.
+    content = {"w": 1, "h": 1, "level": [[300]], "hitmap": [[0]]}
+    eq_(encode_content(content), content)
@@ -1,6 +1,41 @@
+import hashlib
+import json
+import os
+import random
+
 from nose.tools import eq_
 
+import internals.constants as constants
 from internals.locations import Location
+import internals.terraincache as terraincache
+from internals.terraincache import LocalCache
+
+
+# What levels generated to, and the entities spawned in them, before
+# generation had random number generators of its own.
+GENERATED = {
+    "o:0:0": ("97305af82ee05838d3cec562de7a067c",
+              ["Trader", "Trader", "Child", "Child", "Child", "Bully",
+               "Soldier", "Soldier"]),
+    "o:1:0": ("0069808524d28600e81bc218059b4703",
+              ["Sheep", "Sheep", "Sheep", "Sheep", "Wolf"]),
+    "o:-4:7": ("6f7499ed8c51dbd4ab083f7f24e6b1a7", ["Sheep", "Sheep", "Wolf"]),
+    "o:1:0:d:0:1": ("7aa3fa6e6bfefe63476783904b5964eb",
+                    ["DeathWaker", "Zombie", "Zombie"]),
+    "o:0:0:b:1:2:house": ("b4cd4936ce240a88335cb167ea7c1f05",
+                          ["Soldier", "Homely", "Homely", "Homely"]),
+}
+
+
+def setup():
+    global client, client_pid
+    # Levels mustn't come from a cache that other tests or servers filled.
+    client, client_pid = terraincache._client, terraincache._client_pid
+    terraincache._client_pid = os.getpid()
+
+
+def teardown():
+    terraincache._client, terraincache._client_pid = client, client_pid
 
 
 def test_slide():
@@ -17,3 +52,54 @@ def test_slide():
     x = Location("o:0:0:b:1:2:x")
     eq_(x.get_slide_code(-1, -3), "o:0:0:b:-1:-3:x")
 
+
+def test_instances():
+    """Test that instances are parsed and carried into sublocations."""
+    x = Location("o~2:0:0:b:1:2:x")
+    eq_(x.world, "o")
+    eq_(x.instance, 2)
+    eq_(x.get_slide_code(-1, -3), "o~2:0:0:b:-1:-3:x")
+    eq_(x.get_parent_code(), "o~2:0:0")
+    eq_(x.get_instance_code(0), "o:0:0:b:1:2:x")
+
+    x = Location("o~1:0:0")
+    eq_(x.get_slide_code(1, 1), "o:1:1")
+    eq_(Location("o:0:0").instance, 0)
+    eq_(Location("o:0:0").get_instance_code(3), "o~3:0:0")
+
+
+def test_is_valid():
+    """Test that only codes for levels that can exist are accepted."""
+    radius = constants.region_store_radius
+    for code in ("o:0:0", "o~1:0:0", "o:%d:%d" % (-radius, radius - 1),
+                 "o:0:0:b:0:0:shop", "o:1:0:d:0:0", "o:1:0:d:0:0:d:1:0"):
+        assert Location(code).is_valid(), code
+    for code in ("o:%d:0" % radius, "o:0:%d" % (-radius - 1), "o:01:0",
+                 "o~0:0:0", "o:0:0:d:0:0",
+                 "o:0:0:b:0:0:castle", "o:0:0:b:0:0:shop:b:0:0:shop",
+                 "o:1:0:b:0:0:shop", "o:2:0:d:0:0"):
+        assert not Location(code).is_valid(), code
+
+
+def test_deterministic():
+    """
+    Test that generation doesn't depend on the global random state or on what
+    was asked of a location first, and that levels come out as they used to.
+    """
+    def generate(code, prepare):
+        terraincache._client = LocalCache()
+        location = Location(code)
+        prepare(location)
+        return location.generate(), location.get_entities_to_spawn()
+
+    for code, (level_hash, entities) in GENERATED.items():
+        random.seed(1)
+        expected = generate(code, lambda location: None)
+        eq_(hashlib.md5(json.dumps(expected[0], sort_keys=True)).hexdigest(),
+            level_hash, code)
+        eq_([entity.__name__ for entity in expected[1]], entities, code)
+
+        random.seed(2)
+        eq_(generate(code, lambda location: (location.tileset(),
+                                             random.random())),
+            expected)
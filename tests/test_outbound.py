@@ -0,0 +1,58 @@
+from nose.tools import eq_
+
+from internals.outbound import FRAME_SEPARATOR, OutboundQueue, pack_frame
+
+
+def test_collapse():
+    """Test that queued updates to the same entity are merged."""
+    queue = OutboundQueue()
+    queue.push("loca:1:2:0:0")
+    queue.push("epuz:x=1\ny=2")
+    queue.push("locb:5:5:0:0")
+    queue.push("loca:3:4:1:0")
+    queue.push("epuz:y=3\nhealth=9")
+    eq_(queue.pop_all(), ["loca:3:4:1:0", "epuz:x=1\ny=3\nhealth=9",
+                          "locb:5:5:0:0"])
+    eq_(len(queue), 0)
+
+
+def test_limit():
+    """Test that unreliable messages are dropped to make room."""
+    queue = OutboundQueue(limit=3)
+    queue.push("snd1")
+    queue.push("inv0:f5")
+    queue.push("snd2")
+    queue.push("hea90")
+    queue.push("lev{}")
+    eq_(queue.pop_all(), ["inv0:f5", "hea90", "lev{}"])
+
+    queue.push("hea1")
+    queue.push("hea2")
+    queue.push("hea3")
+    queue.push("snd3")
+    eq_(queue.pop_all(), ["hea1", "hea2", "hea3"])
+
+
+def test_lifecycle():
+    """Test that updates aren't merged across an entity being removed."""
+    queue = OutboundQueue()
+    queue.push("loca:1:2:0:0")
+    queue.push("dela")
+    queue.push("adda:0:0")
+    queue.push("loca:3:4:1:0")
+    eq_(queue.pop_all(), ["loca:1:2:0:0", "dela", "adda:0:0",
+                          "loca:3:4:1:0"])
+
+
+def test_frame():
+    """
+    Test that messages come out of a frame the way the client unpacks them,
+    even if one of them contains the separator.
+    """
+    messages = ["loca:1:2:0:0", "epuz:x=1\ny=2",
+                "chaa:1:2\nhello%sthere" % FRAME_SEPARATOR]
+    frame = pack_frame(messages)
+    eq_(frame[:3], "mul")
+    eq_(frame[3:].split(FRAME_SEPARATOR),
+        ["loca:1:2:0:0", "epuz:x=1\ny=2", "chaa:1:2\nhellothere"])
+    eq_(pack_frame(["hea90"])[3:].split(FRAME_SEPARATOR), ["hea90"])
@@ -0,0 +1,54 @@
+from nose.tools import eq_
+
+import internals.constants as constants
+import internals.partitions as partitions
+from internals.sharding import HashRing
+
+
+ENDPOINTS = ["10.0.0.1:6379", "10.0.0.2:6379", "10.0.0.2:6380"]
+LOCATIONS = ["o:%d:%d" % (x, y) for x in range(-10, 10) for y in range(-10, 10)]
+
+
+def setup():
+    global ring, connections
+    # Nothing is connected to until a command is sent, so the endpoints
+    # don't need to exist.
+    ring, connections = partitions._ring, partitions._connections
+    partitions._ring = HashRing(ENDPOINTS)
+    partitions._connections = {}
+
+
+def teardown():
+    partitions._ring, partitions._connections = ring, connections
+
+
+def test_get_endpoint():
+    """Test that locations are spread over the endpoints consistently."""
+    other_ring = HashRing(list(reversed(ENDPOINTS)))
+    for location in LOCATIONS:
+        eq_(partitions.get_endpoint(location), other_ring.get_node(location))
+    eq_(set(map(partitions.get_endpoint, LOCATIONS)), set(ENDPOINTS))
+
+
+def test_connect():
+    connection = partitions.connect("10.0.0.2:6380")
+    kwargs = connection.connection_pool.connection_kwargs
+    eq_((kwargs["host"], kwargs["port"]), ("10.0.0.2", 6380))
+    assert partitions.connect("10.0.0.2:6380") is not connection
+
+
+def test_get_redis():
+    """
+    Test that locations share a connection to their endpoint, and that the
+    global connection is to constants.redis.
+    """
+    for location in LOCATIONS:
+        connection = partitions.get_redis(location)
+        assert connection is partitions.get_redis(location)
+        kwargs = connection.connection_pool.connection_kwargs
+        eq_("%s:%d" % (kwargs["host"], kwargs["port"]),
+            partitions.get_endpoint(location))
+    eq_(len(partitions._connections), len(ENDPOINTS))
+
+    kwargs = partitions.get_redis().connection_pool.connection_kwargs
+    eq_("%s:%d" % (kwargs["host"], kwargs["port"]), constants.redis)
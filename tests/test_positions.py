@@ -0,0 +1,27 @@
+from nose.tools import eq_
+
+from internals.positions import PositionStore
+
+
+def test_coalescing():
+    """Test that only the latest changed position is waiting to be written."""
+    store = PositionStore()
+    store.update("o:0:0", "a", 1, 2)
+    store.update("o:0:0", "a", 3, 4)
+    eq_(store.pending, {"a": ("o:0:0", "a:3:4")})
+
+    store.wrote("a", "a:3:4")
+    store.update("o:0:0", "a", 3, 4)
+    eq_(store.pending, {})
+
+    store.update("o:0:0", "a", 5, 6)
+    store.discard("a")
+    eq_(store.pending, {})
+    eq_(store.written, {})
+
+
+def test_no_location():
+    """Test that positions aren't recorded for players between levels."""
+    store = PositionStore()
+    store.update(None, "a", 1, 2)
+    eq_(store.pending, {})
@@ -0,0 +1,13 @@
+from nose.tools import eq_
+
+import internals.prefetch as prefetch
+from internals.locations import Location
+
+
+def test_due():
+    """Test that levels are prefetched near the edges and portals."""
+    targets = prefetch.targets(Location("o:1:0"))
+    eq_(prefetch.due(targets, 20, 50), [])
+    eq_(prefetch.due(targets, 2, 10), ["o:0:0"])
+    eq_(prefetch.due(targets, 73, 73), ["o:2:0", "o:1:1"])
+    eq_(prefetch.due(targets, 36, 30), ["o:1:0:d:0:0"])
@@ -0,0 +1,25 @@
+from nose.tools import eq_
+
+from internals.locations import Location
+import pregenerate
+
+
+def test_region_order():
+    """Test that regions closest to the origin come first."""
+    regions = pregenerate.region_order(-2, -2, 2, 2)
+    eq_(len(regions), 16)
+    eq_(regions[0], (0, 0))
+    eq_(sorted(regions[1:9]), [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1),
+                               (1, -1), (1, 0), (1, 1)])
+
+
+def test_sublocation_codes():
+    """Test that dungeon rooms and building interiors are found."""
+    rooms = pregenerate.sublocation_codes(Location("o:1:0"))
+    assert "o:1:0:d:0:0" in rooms
+    for code in rooms:
+        Location(code).generate()
+
+    eq_(pregenerate.sublocation_codes(Location("o:0:0")),
+        ["o:0:0:b:0:0:house", "o:0:0:b:0:0:shop"])
+    eq_(pregenerate.sublocation_codes(Location("o:5:5")), [])
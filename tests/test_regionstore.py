@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, raises
+
+import internals.constants as constants
+import internals.regionstore as regionstore
+from internals.locations import Location
+from internals.regionstore import RegionStore, SublocationStore
+
+
+def setup():
+    global store_dir
+    store_dir = tempfile.mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(store_dir)
+
+
+def test_store():
+    """Test that stored regions come back the same from another mapping."""
+    path = os.path.join(store_dir, "o.regions")
+    generated = Location("o:1:0").generate()
+    writer = RegionStore(path, writable=True, radius=2)
+    assert writer.save(1, 0, *generated)
+    assert not writer.save(2, 0, *generated)
+    writer.close()
+
+    reader = RegionStore(path, radius=2)
+    assert reader.has(1, 0)
+    assert not reader.has(0, 1)
+    eq_(reader.load(1, 0), generated)
+    eq_(reader.load(0, 1), None)
+    eq_(reader.load(-3, 0), None)
+
+    # Locations use the store before generating anything.
+    regionstore._stores["t", "regions"] = reader
+    try:
+        eq_(Location("t~1:1:0").generate(), generated)
+    finally:
+        del regionstore._stores["t", "regions"]
+    reader.close()
+
+
+def test_sublocations():
+    """
+    Test that stored sublocations come back the same, and that a record that
+    was cut off is dropped.
+    """
+    path = os.path.join(store_dir, "o.sublocations")
+    room = Location("o:1:0:d:0:0").generate()
+    house = Location("o:0:0:b:0:0:house").generate()
+    writer = SublocationStore(path, writable=True)
+    assert writer.save("o:1:0:d:0:0", *room)
+    assert writer.save("o:0:0:b:0:0:house", *house)
+    writer.close()
+    with open(path, "r+b") as store_file:
+        store_file.truncate(os.path.getsize(path) - 1)
+
+    writer = SublocationStore(path, writable=True)
+    assert writer.has("o:1:0:d:0:0")
+    assert not writer.has("o:0:0:b:0:0:house")
+    assert writer.save("o:0:0:b:0:0:house", *house)
+    writer.close()
+
+    reader = SublocationStore(path)
+    eq_(reader.load("o:1:0:d:0:0"), room)
+    eq_(reader.load("o:0:0:b:0:0:house"), house)
+    eq_(reader.load("o:0:0:b:0:0:shop"), None)
+
+    regionstore._stores["t", "sublocations"] = reader
+    try:
+        eq_(Location("t~1:1:0:d:0:0").generate(), room)
+    finally:
+        del regionstore._stores["t", "sublocations"]
+    reader.close()
+
+
+def test_open_stores():
+    """Test that every store in the directory is opened up front."""
+    path = os.path.join(store_dir, "w.sublocations")
+    writer = SublocationStore(path, writable=True)
+    assert writer.save("w:1:0:d:0:0", *Location("o:1:0:d:0:0").generate())
+    writer.close()
+
+    stores, store_path = regionstore._stores, constants.region_store_path
+    regionstore._stores = {}
+    constants.region_store_path = store_dir
+    try:
+        regionstore.open_stores()
+        assert regionstore._stores["w", "sublocations"].has("w:1:0:d:0:0")
+        for store in regionstore._stores.values():
+            if store:
+                store.close()
+    finally:
+        regionstore._stores, constants.region_store_path = stores, store_path
+
+
+@raises(ValueError)
+def test_settings():
+    """Test that a store can't be read with other settings."""
+    path = os.path.join(store_dir, "other.regions")
+    RegionStore(path, writable=True, radius=2).close()
+    RegionStore(path, radius=3)
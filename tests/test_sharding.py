@@ -0,0 +1,49 @@
+from nose.tools import eq_
+
+from internals.sharding import HashRing
+
+
+LOCATIONS = ["o:%d:%d" % (x, y) for x in range(-20, 20) for y in range(-20, 20)]
+
+
+def test_get_node():
+    """Test that locations map to the same node every time."""
+    ring = HashRing(["a", "b", "c"])
+    other_ring = HashRing(["c", "a", "b"])
+    for location in LOCATIONS:
+        eq_(ring.get_node(location), other_ring.get_node(location))
+
+    eq_(HashRing().get_node("o:0:0"), None)
+
+
+def test_spread():
+    """Test that virtual nodes spread locations roughly evenly."""
+    ring = HashRing(["a", "b", "c", "d"])
+    counts = {}
+    for location in LOCATIONS:
+        node = ring.get_node(location)
+        counts[node] = counts.get(node, 0) + 1
+
+    eq_(sorted(counts.keys()), ["a", "b", "c", "d"])
+    expected = len(LOCATIONS) / 4
+    for node, count in counts.items():
+        assert expected / 2 < count < expected * 2, (node, count)
+
+
+def test_minimal_movement():
+    """
+    Test that adding a node only moves locations onto the new node and that
+    removing it moves them back.
+    """
+    ring = HashRing(["a", "b", "c"])
+    before = dict((l, ring.get_node(l)) for l in LOCATIONS)
+
+    ring.add_node("d")
+    after = dict((l, ring.get_node(l)) for l in LOCATIONS)
+    for location in LOCATIONS:
+        if before[location] != after[location]:
+            eq_(after[location], "d")
+
+    ring.remove_node("d")
+    for location in LOCATIONS:
+        eq_(ring.get_node(location), before[location])
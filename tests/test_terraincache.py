@@ -0,0 +1,34 @@
+import os
+
+from nose.tools import eq_
+
+import internals.terraincache as terraincache
+from internals.locations import Location
+from internals.terraincache import LocalCache
+
+
+def setup():
+    global client, client_pid
+    # The tests use a cache of their own, even if memcached is configured.
+    client, client_pid = terraincache._client, terraincache._client_pid
+    terraincache._client, terraincache._client_pid = LocalCache(), os.getpid()
+
+
+def teardown():
+    terraincache._client, terraincache._client_pid = client, client_pid
+
+
+def test_pack():
+    """Test that packed terrain comes back the same."""
+    generated = Location("o:1:0").generate()
+    eq_(terraincache.unpack(terraincache.pack(*generated)), generated)
+    eq_(terraincache.pack([[256 * 256]], [[0]], []), None)
+
+
+def test_shared():
+    """Test that generated terrain is shared between Locations."""
+    terraincache.save("o:4:4", [[1, 2]], [[0, 1]], [])
+    eq_(Location("o~2:4:4").generate(), ([[1, 2]], [[0, 1]], []))
+
+    generated = Location("o:4:5").generate()
+    eq_(terraincache.load("o:4:5"), generated)
@@ -1,20 +1,39 @@
 import json
 import os
+import signal
+import time
 
 import brukva
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
+import internals.cluster as cluster
 import internals.comm
 import internals.constants as constants
+import internals.generation as generation
+import internals.levelcache as levelcache
+import internals.metrics as metrics
 import internals.brukva_setup as brukva_setup
+from internals.locations import Location
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
-brukva_client = None
+brukva_clients = {}
+servers = []
+heartbeat = None
+# When the IOLoop last checked how late it was running.
+last_stall_check = None
 local_settings = {"port": constants.port,
-                  "tilesize": constants.tilesize}
+                  "tilesize": constants.tilesize,
+                  "workers": constants.web_workers,
+                  # The host that players are redirected to when they're moved
+                  # to one of this server's workers. If it's blank, they'll
+                  # reconnect to the host that served the page.
+                  "host": ""}
 
 
 index_cache = None
@@ -34,16 +53,149 @@ class LOAHandler(tornado.web.RequestHandler):
         self.write(index_cache)
 
 
+class LevelHandler(tornado.web.RequestHandler):
+    """
+    Server of the static content of levels. Content never changes for a
+    given level version, so it's cached for a long time.
+    """
+
+    @tornado.web.asynchronous
+    def get(self, version, code):
+        if int(version) != constants.level_version:
+            raise tornado.web.HTTPError(404)
+        try:
+            location = Location(code)
+        except (IndexError, KeyError, ValueError):
+            raise tornado.web.HTTPError(404)
+        if not location.is_valid():
+            raise tornado.web.HTTPError(404)
+
+        generation.load(location,
+                        lambda loaded: self._respond(location, loaded))
+
+    def _respond(self, location, loaded):
+        if not loaded:
+            self.send_error(404)
+            return
+        level = levelcache.get_level(location)
+        gzipped = (level.gzipped is not None and
+                   "gzip" in self.request.headers.get("Accept-Encoding", ""))
+
+        # The two encodings are different bytes, so they have different tags.
+        etag = '"%s%s"' % (level.hash, "-gzip" if gzipped else "")
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control",
+                        "public, max-age=%d" % constants.level_max_age)
+        self.set_header("Vary", "Accept-Encoding")
+        if etag in [tag.strip() for tag in
+                    self.request.headers.get("If-None-Match", "").split(",")]:
+            self.set_status(304)
+            self.finish()
+            return
+
+        self.set_header("Content-Type", "application/json")
+        if gzipped:
+            self.set_header("Content-Encoding", "gzip")
+            self.write(level.gzipped)
+        else:
+            self.write(level.content)
+        self.finish()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Server of this worker's counters, as JSON."""
+
+    def get(self):
+        self.write(metrics.snapshot())
+
+
 settings = {"static_path": os.path.join(current_dir, "www"),
             "auto_reload": True}
 application = tornado.web.Application([
     (r"/", LOAHandler),
     (r"/socket", internals.comm.CommHandler),
+    (r"/level/(\d+)/([^/]+)", LevelHandler),
+    (r"/metrics", MetricsHandler),
 ], **settings)
 
 
+def drain():
+    """
+    Stop accepting connections and move the connected players to other
+    workers, a batch at a time, then shut down.
+    """
+    print "Draining %d connections" % len(internals.comm.connections)
+    for server in servers:
+        server.stop()
+    heartbeat.stop()
+    cluster.leave()
+
+    _drain_batch(list(internals.comm.connections))
+
+
+def _drain_batch(queue):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    if not queue:
+        # Give the last batch a moment to reconnect before going away.
+        io_loop.add_timeout(time.time() + constants.drain_interval,
+                            io_loop.stop)
+        return
+
+    # If there's nowhere else to go, players are sent back to the shared port
+    # to be picked up by whatever is serving it.
+    fallback = "%s:%d" % (local_settings["host"], local_settings["port"])
+    batch = queue[:constants.drain_batch_size]
+    for client in batch:
+        if client not in internals.comm.connections:
+            continue
+        location = client.location or client.loading
+        if not client.id or not location:
+            client.close()
+            continue
+
+        worker = cluster.handoff_target(location, fallback)
+        if worker == cluster.membership.node_id:
+            # With a single worker, the fallback is the port that's being
+            # stopped. The player is disconnected (and leaves their location)
+            # instead.
+            client.close()
+        elif client.loading:
+            # The other worker loads the level that the player was waiting
+            # for.
+            avx, avy = client.loading_position
+            client.location, client.loading = client.loading, None
+            client.redirect(worker, avx, avy)
+        else:
+            client.redirect(worker)
+
+    io_loop.add_timeout(time.time() + constants.drain_interval,
+                        lambda: _drain_batch(queue[len(batch):]))
+
+
+def _check_stall():
+    """
+    Record how much later than scheduled this ran. Anything that holds up the
+    IOLoop, like generating a level on it, shows up here.
+    """
+    global last_stall_check
+    now = time.time()
+    if last_stall_check is not None:
+        stall = now - last_stall_check - constants.stall_check_interval
+        stall = max(int(stall * 1000), 0)
+        metrics.set_gauge("ioloop.stall_ms", stall)
+        metrics.set_gauge("ioloop.max_stall_ms",
+                          max(stall, metrics.gauges.get("ioloop.max_stall_ms",
+                                                        0)))
+        metrics.incr("ioloop.total_stall_ms", stall)
+    last_stall_check = now
+
+
+def _on_signal(signum, frame):
+    tornado.ioloop.IOLoop.instance().add_callback(drain)
+
+
 def start():
-    global brukva_client
+    global heartbeat
 
     config_path = os.path.join(os.path.dirname(__file__),
                                "config.conf")
@@ -53,16 +205,68 @@ def start():
             new_local_settings = json.loads(config_file.read())
     local_settings.update(new_local_settings)
     port = local_settings["port"]
-    application.listen(local_settings["port"])
+    workers = local_settings["workers"]
+    sockets = []
+    if workers > 1:
+        # Fork the workers after binding so that they all accept connections
+        # on the shared port. Redis and brukva connections are made after the
+        # fork so that every worker gets its own.
+        sockets = tornado.netutil.bind_sockets(port)
+        task_id = tornado.process.fork_processes(workers)
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+        servers.append(server)
+
+        worker_port = port + 1 + task_id
+    else:
+        worker_port = port
+
+    # The generation pool is started before any connections are made so that
+    # its processes don't inherit them. The shared listening sockets are
+    # closed in its processes.
+    generation.start(sockets=sockets)
+
+    server = tornado.httpserver.HTTPServer(application)
+    server.listen(worker_port)
+    servers.append(server)
+
+    cluster.join("%s:%d" % (local_settings["host"], worker_port))
+    heartbeat = tornado.ioloop.PeriodicCallback(
+            cluster.heartbeat, constants.node_heartbeat * 1000)
+    heartbeat.start()
+    tornado.ioloop.PeriodicCallback(internals.comm.expire_handoffs,
+                                    constants.node_heartbeat * 1000).start()
+    tornado.ioloop.PeriodicCallback(internals.comm.process_input,
+                                    constants.TICK * 1000).start()
+    tornado.ioloop.PeriodicCallback(internals.comm.flush_outbound,
+                                    constants.TICK * 1000).start()
+    tornado.ioloop.PeriodicCallback(
+            internals.comm.positions.flush,
+            constants.position_flush_interval * 1000).start()
+    tornado.ioloop.PeriodicCallback(
+            _check_stall, constants.stall_check_interval * 1000).start()
+    if constants.instance_capacity:
+        tornado.ioloop.PeriodicCallback(
+                internals.comm.merge_instances,
+                constants.instance_merge_interval * 1000).start()
+
+    # SIGTERM drains the worker so that restarts don't drop anyone.
+    signal.signal(signal.SIGTERM, _on_signal)
 
-    redis_host, redis_port = constants.redis.split(":")
-    brukva_client = brukva.Client(host=redis_host, port=int(redis_port))
-    brukva_client.connect()
+    # Each Redis instance that holds locations needs its own subscriber.
+    for endpoint in constants.redis_locations:
+        redis_host, redis_port = endpoint.split(":")
+        client = brukva.Client(host=redis_host, port=int(redis_port))
+        client.connect()
+        brukva_setup.setup_brukva(client)
+        brukva_clients[endpoint] = client
 
-    internals.comm.brukva = brukva_client
-    brukva_setup.setup_brukva(brukva_client)
+    internals.comm.brukva = brukva_clients
 
-    tornado.ioloop.IOLoop.instance().start()
+    try:
+        tornado.ioloop.IOLoop.instance().start()
+    finally:
+        cluster.leave()
 
 if __name__ == "__main__":
     start()
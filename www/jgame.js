@@ -660,7 +660,7 @@ var jgutils = {
                 loadutils.complete_task("comm");
                 return;
             }
-            jgutils.comm.socket = new WebSocket("ws://" + document.domain + ":" + jgame.port + "/socket");
+            jgutils.comm.socket = new WebSocket("ws://" + document.domain + ":" + jgame.port + jgutils.comm.socket_path());
             jgutils.comm.socket.onopen = function(message) {
                 jgutils.comm.socket.onmessage = jgutils.comm.handle_message;
                 if(jgutils.comm.registrar) {
@@ -669,7 +669,41 @@ var jgutils = {
                 }
             };
         },
+        held : null,
+        release_held : function() {
+            // Handle the messages that were held while a level loaded.
+            var held = jgutils.comm.held;
+            jgutils.comm.held = null;
+            if(!held)
+                return;
+            for(var i = 0; i < held.length; i++)
+                jgutils.comm.handle_message(held[i]);
+        },
+        clock_offset : null,
+        server_elapsed : function(timestamp) {
+            // Estimate how long ago the server sent a message, assuming that
+            // the quickest message so far arrived instantly.
+            var offset = (new Date()).getTime() - timestamp;
+            if(jgutils.comm.clock_offset === null || offset < jgutils.comm.clock_offset)
+                jgutils.comm.clock_offset = offset;
+            return offset - jgutils.comm.clock_offset;
+        },
+        socket_path : function() {
+            return "/socket" + (jgame.multi_frames ? "?frames=1" : "");
+        },
         handle_message : function(message) {
+            if(jgutils.comm.held) {
+                // Hold everything until the level that's loading is ready.
+                jgutils.comm.held.push(message);
+                return;
+            }
+            if(message.data.substr(0, 3) == "mul") {
+                // Several messages packed into one frame
+                var messages = message.data.substr(3).split("\x1e");
+                for(var i = 0; i < messages.length; i++)
+                    jgutils.comm.handle_message({data: messages[i]});
+                return;
+            }
             if(jgame.show_epu || message.data.substr(0, 3) != "epu")
                 if(!jgame.filter_console || message.data.indexOf(jgame.filter_console) > -1)
                     console.log("Server message: [" + message.data + "]");
@@ -705,9 +739,19 @@ var jgutils = {
                 case "loc": // Change avatar position and direction
                     var data = body.split(":");
                     var av = jgutils.avatars.registry[data[0]];
-                    av.x = parseInt(data[1]);
-                    av.y = parseInt(data[2]);
                     var new_direction = [data[3] * 1, data[4] * 1];
+                    if(data.length > 5) {
+                        // Account for the time that the update spent getting
+                        // here, then ease into the new position rather than
+                        // jumping to it.
+                        var elapsed = jgutils.comm.server_elapsed(data[5] * 1),
+                            x = parseInt(data[1]) + new_direction[0] * jgame.speed * elapsed,
+                            y = parseInt(data[2]) + new_direction[1] * jgame.speed * elapsed;
+                        av.correction = {x: x - av.x, y: y - av.y, remaining: jgame.correction_time};
+                    } else {
+                        av.x = parseInt(data[1]);
+                        av.y = parseInt(data[2]);
+                    }
                     if(jgame.follow_avatar == data[0])
                         jgutils.level.setCenterPosition(true);
 
@@ -748,7 +792,27 @@ var jgutils = {
                     jgutils.level.expect(body);
                     break;
                 case "lev":
-                    jgutils.comm._level_callback(JSON.parse(body))
+                    var level = JSON.parse(body);
+                    if(level.level) {
+                        jgutils.comm._level_callback(level);
+                        break;
+                    }
+                    jgutils.comm.held = [];
+                    jgutils.levels.get(level, function(data) {
+                        jgutils.comm._level_callback(data);
+                        jgutils.comm.release_held();
+                    }, function() {
+                        // Don't hold messages forever for a level that
+                        // won't come.
+                        chatutils.handleMessage("The level couldn't be loaded. Reload the page to try again.");
+                        jgutils.comm.release_held();
+                    });
+                    break;
+                case "pre": // Fetch a level that the player is heading for
+                    jgutils.levels.get(JSON.parse(body), function() {});
+                    break;
+                case "rdr": // Move to another server
+                    jgutils.comm.redirect(body);
                     break;
                 case "epu":
                     var body = body.explode(":", 1),
@@ -756,14 +820,31 @@ var jgutils = {
                         entity = jgutils.objects.registry[body[0]];
                     if(!entity)
                         break;
+                    var changes = {};
                     for(var i = 0; i < data.length; i++) {
-                        var line = data[i].explode("=", 2),
-                            key = line[0],
-                            value = JSON.parse(line[1]);
-                        if(key == "x" || key == "y")
-                            entity[key] = value * jgame.tilesize;
-                        else
-                            entity[key] = value;
+                        var line = data[i].explode("=", 2);
+                        changes[line[0]] = JSON.parse(line[1]);
+                    }
+                    for(var key in changes) {
+                        if(key == "t")
+                            continue;
+                        if(key == "x" || key == "y") {
+                            if(!("t" in changes))
+                                entity[key] = changes[key] * jgame.tilesize;
+                        } else
+                            entity[key] = changes[key];
+                    }
+                    if("t" in changes) {
+                        // Move the position on by the time the update spent
+                        // getting here, and ease into it like avatars do.
+                        var elapsed = jgutils.comm.server_elapsed(changes.t),
+                            velocity = adjust_diagonal([entity.x_vel, entity.y_vel]),
+                            distance = jgame.speed * entity.speed * elapsed,
+                            x = "x" in changes ? changes.x * jgame.tilesize : entity.x,
+                            y = "y" in changes ? changes.y * jgame.tilesize : entity.y;
+                        x += velocity[0] * distance;
+                        y += velocity[1] * distance;
+                        entity.correction = {x: x - entity.x, y: y - entity.y, remaining: jgame.correction_time};
                     }
                     break;
                 case "hea":
@@ -806,12 +887,180 @@ var jgutils = {
                 jgutils.comm.init();
             }
         },
+        redirect : function(address) {
+            // The level callback stays in place; the new server sends the
+            // level once the session is resumed.
+            var data = address.split(":"),
+                host = data[0] || document.domain;
+            jgutils.comm.socket.onmessage = null;
+            jgutils.comm.socket.close();
+            jgutils.comm.socket = new WebSocket("ws://" + host + ":" + data[1] + jgutils.comm.socket_path());
+            jgutils.comm.socket.onopen = function(message) {
+                jgutils.comm.socket.onmessage = jgutils.comm.handle_message;
+                // The token proves that this is the player who was redirected.
+                jgutils.comm.send("res", jgutils.comm.local_id + ":" + data[2]);
+            };
+        },
         send : function(header, body) {
             if(!jgutils.comm.socket)
                 return;
             jgutils.comm.socket.send(header + "\n" + body);
         }
     },
+    levels : {
+        // Level content by hash, most recently used last
+        cache : {},
+        order : [],
+        get : function(level, callback, failed) {
+            // Get a level's content and pass it to `callback`. `failed` is
+            // called if it can't be fetched after a few attempts.
+            var levels = jgutils.levels;
+            function done(content) {
+                levels.remember(level.hash, content);
+                var data = levels.decode(content);
+                data.avatar = level.avatar;
+                data.health = level.health;
+                callback(data);
+            }
+
+            if(level.hash in levels.cache)
+                return done(levels.cache[level.hash]);
+            var key = "level:" + level.version + ":" + level.hash;
+            levels.load_stored(level.version);
+            try {
+                var stored = window.localStorage.getItem(key);
+                if(stored) {
+                    levels.touch_stored(key);
+                    return done(JSON.parse(stored));
+                }
+            } catch(e) {}
+
+            var attempts = 0;
+            function fetch() {
+                $.getJSON("/level/" + level.version + "/" + encodeURIComponent(level.code)).done(function(content, status, xhr) {
+                    // The ETag is the hash of the content that was served.
+                    // Other content is for another deploy, so it isn't kept.
+                    var etag = (xhr.getResponseHeader("Etag") || "").replace(/"|-gzip/g, "");
+                    if(etag != level.hash)
+                        return retry();
+                    levels.store(key, JSON.stringify(content));
+                    done(content);
+                }).fail(retry);
+            }
+            function retry() {
+                attempts++;
+                if(attempts < jgame.level_attempts)
+                    setTimeout(fetch, attempts * 1000);
+                else if(failed)
+                    failed();
+            }
+            fetch();
+        },
+        // The localStorage keys of the stored levels, least recently used
+        // first. This is kept in localStorage under "levels".
+        stored : null,
+        load_stored : function(version) {
+            // Read the index of stored levels, and drop the levels that were
+            // stored for other level versions or that it's lost track of.
+            var levels = jgutils.levels;
+            if(levels.stored !== null)
+                return;
+            levels.stored = [];
+            try {
+                var index = JSON.parse(window.localStorage.getItem("levels") || "[]"),
+                    prefix = "level:" + version + ":";
+                for(var i = 0; i < index.length; i++)
+                    if(index[i].indexOf(prefix) == 0)
+                        levels.stored.push(index[i]);
+                for(var i = window.localStorage.length - 1; i >= 0; i--) {
+                    var key = window.localStorage.key(i);
+                    if(key.indexOf("level:") == 0 && levels.stored.indexOf(key) == -1)
+                        window.localStorage.removeItem(key);
+                }
+                levels.set_item("levels", JSON.stringify(levels.stored));
+            } catch(e) {} // Storage is unavailable
+        },
+        touch_stored : function(key) {
+            var levels = jgutils.levels,
+                index = levels.stored.indexOf(key);
+            if(index > -1)
+                levels.stored.splice(index, 1);
+            levels.stored.push(key);
+            levels.set_item("levels", JSON.stringify(levels.stored));
+        },
+        store : function(key, data) {
+            var levels = jgutils.levels;
+            if(!levels.set_item(key, data))
+                return;
+            levels.touch_stored(key);
+            while(levels.stored.length > jgame.stored_levels)
+                window.localStorage.removeItem(levels.stored.shift());
+            levels.set_item("levels", JSON.stringify(levels.stored));
+        },
+        set_item : function(key, value) {
+            // Store a value, making room by dropping the least recently used
+            // levels if storage is full. Returns whether it was stored.
+            var levels = jgutils.levels;
+            while(true) {
+                try {
+                    window.localStorage.setItem(key, value);
+                    return true;
+                } catch(e) {
+                    var full = e.name == "QuotaExceededError" ||
+                               e.name == "NS_ERROR_DOM_QUOTA_REACHED";
+                    if(!full || !levels.stored || !levels.stored.length)
+                        return false;
+                    var dropped = levels.stored.shift();
+                    if(dropped == key)
+                        continue;
+                    window.localStorage.removeItem(dropped);
+                }
+            }
+        },
+        decode : function(content) {
+            // Expand the compact terrain and hitmap encoding from
+            // internals/levelcodec.py. Returns a copy of the content.
+            var data = $.extend({}, content);
+            if(!content.encoding)
+                return data;
+            delete data.encoding;
+
+            var w = content.w, h = content.h,
+                raw = atob(content.level),
+                tiles = [];
+            for(var i = 0; i < raw.length; i += 2) {
+                var count = raw.charCodeAt(i),
+                    tile = raw.charCodeAt(i + 1);
+                for(var j = 0; j < count; j++)
+                    tiles.push(tile);
+            }
+            data.level = [];
+            for(var y = 0; y < h; y++)
+                data.level.push(tiles.slice(y * w, (y + 1) * w));
+
+            raw = atob(content.hitmap);
+            data.hitmap = [];
+            for(var y = 0; y < h; y++) {
+                var row = [];
+                for(var x = 0; x < w; x++) {
+                    var bit = y * w + x;
+                    row.push(raw.charCodeAt(bit >> 3) >> (7 - (bit & 7)) & 1);
+                }
+                data.hitmap.push(row);
+            }
+            return data;
+        },
+        remember : function(hash, content) {
+            var levels = jgutils.levels,
+                index = levels.order.indexOf(hash);
+            if(index > -1)
+                levels.order.splice(index, 1);
+            levels.order.push(hash);
+            levels.cache[hash] = content;
+            if(levels.order.length > jgame.cached_levels)
+                delete levels.cache[levels.order.shift()];
+        }
+    },
     objects : {
         layers : {},
         registry : {},
@@ -1070,6 +1319,23 @@ var jgutils = {
                 callback : callback
             };
         },
+        ease : function(thing, ms) {
+            // Move an avatar or object part of the way to its corrected
+            // position. Returns whether it moved.
+            if(!thing.correction)
+                return false;
+            var share = Math.min(ms / thing.correction.remaining, 1),
+                dx = thing.correction.x * share,
+                dy = thing.correction.y * share;
+            thing.x += dx;
+            thing.y += dy;
+            thing.correction.x -= dx;
+            thing.correction.y -= dy;
+            thing.correction.remaining -= ms;
+            if(thing.correction.remaining <= 0)
+                delete thing.correction;
+            return true;
+        },
         tick : function() {
             var ticks = (new Date()).getTime(),
                 timing = jgutils.timing,
@@ -1215,6 +1481,8 @@ var jgutils = {
 
             for(var av in jgutils.avatars.registry) {
                 var a = jgutils.avatars.registry[av];
+                if(jgutils.timing.ease(a, ms))
+                    do_redraw_avs = true;
                 if(a.direction[0] || a.direction[1]) {
                     if(av != "local") {
                         var adjusted_dir = adjust_diagonal(a.direction);
@@ -1249,7 +1517,8 @@ var jgutils = {
                     otick = ticks / mod_dur % mod_sec;
 
                 // Outsourced for easy update as well as setup.
-                if(jgutils.objects.update(obj, otick, _val))
+                var eased = jgutils.timing.ease(obj, ms);
+                if(jgutils.objects.update(obj, otick, _val) || eased)
                     jgutils.objects.layers[obj.registry_layer].updated = true;
             }
 